@@ -0,0 +1,239 @@
+import collections
+import queue
+import random
+import re
+import sys
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+from tqdm import tqdm
+
+# AIMD (additive increase, multiplicative decrease) concurrency for Earth Engine fetch jobs.
+# The pool is sized for the most parallelism we would ever want; the controller decides how
+# many jobs are actually in flight, growing while requests succeed and halving on quota /
+# 429 / 503 / timeout signals. Throttled jobs are retried with exponential backoff.
+
+THROTTLE_STATUS_CODES = {429, 503}
+# the codes only count as whole numbers, "429" also turns up inside asset ids and dates
+# (LC08_015029_20210429) and "503" inside hashes
+THROTTLE_STATUS_PATTERN = re.compile(r"\b(429|503)\b")
+THROTTLE_SIGNALS = [
+    "too many concurrent",
+    "too many requests",
+    "service unavailable",
+    "quota",
+    "rate limit",
+    "computation timed out",
+    "deadline exceeded",
+]
+
+
+def classify_exception(e):
+    # requests.HTTPError carries the real status code, but quota and rate limit messages can still
+    # come with another one (e.g. 403), so the message is checked too
+    response = getattr(e, "response", None)
+    status_code = getattr(response, "status_code", None)
+    if status_code in THROTTLE_STATUS_CODES:
+        return "throttled"
+
+    message = str(e).lower()
+    if status_code is None and THROTTLE_STATUS_PATTERN.search(message):
+        return "throttled"  # no response to ask, e.g. an ee.EEException
+    for signal in THROTTLE_SIGNALS:
+        if signal in message:
+            return "throttled"
+    return "error"  # e.g. NO IMAGES FOUND, retrying will not help
+
+
+def call_and_classify(fn, job):
+    # runs in the worker, exceptions are turned into results so the parent can react to them
+    try:
+        return "ok", fn(job), None
+    except Exception as e:
+        return classify_exception(e), None, repr(e)
+
+
+class AdaptiveConcurrencyController:
+    def __init__(
+        self, initial_limit=8, min_limit=1, max_limit=40, decrease_factor=0.5
+    ):
+        self.limit = initial_limit
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.decrease_factor = decrease_factor
+
+        self.successes_since_increase = 0
+        self.submitted = 0
+        self.last_decrease_submission = 0
+
+        self.successes = 0
+        self.throttles = 0
+        self.errors = 0
+        self.retries = 0
+
+    def next_submission_number(self):
+        self.submitted += 1
+        return self.submitted
+
+    def on_success(self):
+        self.successes += 1
+        self.successes_since_increase += 1
+        if self.successes_since_increase >= self.limit:  # +1 per "window" of successes
+            self.limit = min(self.max_limit, self.limit + 1)
+            self.successes_since_increase = 0
+
+    def on_throttle(self, submission_number):
+        self.throttles += 1
+        # jobs that were already in flight when we last backed off would all report the
+        # same overload, only let newer ones shrink the limit again
+        if submission_number > self.last_decrease_submission:
+            self.limit = max(self.min_limit, int(self.limit * self.decrease_factor))
+            self.successes_since_increase = 0
+            self.last_decrease_submission = self.submitted
+
+    def on_error(self):
+        self.errors += 1
+
+    def progress_postfix(self):
+        finished = max(1, self.successes + self.throttles + self.errors)
+        return {
+            "limit": self.limit,
+            "throttled": f"{self.throttles / finished:.1%}",
+            "errors": f"{self.errors / finished:.1%}",
+            "retries": self.retries,
+        }
+
+
+def run_adaptively(
+    pool,
+    fn,
+    jobs,
+    controller: AdaptiveConcurrencyController,
+    max_retries=6,
+    base_backoff_seconds=2,
+    on_result=None,
+):
+    # pool is anything with apply_async (multiprocessing.Pool, ThreadPool)
+    pending = collections.deque((job, 0, 0.0) for job in jobs)  # job, attempts, not_before
+    in_flight = {}  # submission_number -> (job, attempts)
+    finished = queue.Queue()  # filled by the pool's result thread the moment a job returns
+    failures = []
+
+    def submit(job, attempts):
+        submission_number = controller.next_submission_number()
+        in_flight[submission_number] = (job, attempts)
+        pool.apply_async(
+            call_and_classify,
+            (fn, job),
+            callback=lambda outcome: finished.put((submission_number, outcome)),
+            error_callback=lambda e: finished.put(
+                (submission_number, ("error", None, repr(e)))
+            ),
+        )
+
+    progress_bar = tqdm(total=len(pending))
+    while pending or in_flight:
+        now = time.monotonic()
+        next_not_before = None  # earliest backed off job, if nothing else will wake us
+        for _ in range(len(pending)):
+            if len(in_flight) >= controller.limit:
+                next_not_before = None  # a finishing job frees a slot first
+                break
+            job, attempts, not_before = pending.popleft()
+            if not_before > now:
+                pending.append((job, attempts, not_before))  # still backing off
+                if next_not_before is None or not_before < next_not_before:
+                    next_not_before = not_before
+                continue
+            submit(job, attempts)
+
+        try:
+            submission_number, (status, result, error) = finished.get(
+                timeout=(
+                    None
+                    if next_not_before is None
+                    else max(0.0, next_not_before - time.monotonic())
+                )
+            )
+        except queue.Empty:
+            continue  # a backed off job is due and there is a free slot for it
+        job, attempts = in_flight.pop(submission_number)
+
+        if status == "throttled" and attempts < max_retries:
+            controller.on_throttle(submission_number)
+            controller.retries += 1
+            backoff = base_backoff_seconds * (2**attempts) * random.uniform(0.5, 1.5)
+            pending.append((job, attempts + 1, time.monotonic() + backoff))
+            progress_bar.set_postfix(controller.progress_postfix())
+            continue
+
+        if status == "ok":
+            controller.on_success()
+        else:
+            if status == "throttled":  # out of retries
+                controller.on_throttle(submission_number)
+            else:
+                controller.on_error()
+            failures.append((job, error))
+        if on_result is not None:
+            on_result(status, result, error)
+        progress_bar.update(1)
+        progress_bar.set_postfix(controller.progress_postfix())
+    progress_bar.close()
+
+    return failures
+
+
+class FakeThrottlingService:
+    # stand in for Earth Engine: rejects calls beyond `capacity` concurrent ones
+    def __init__(self, capacity, call_seconds=0.05):
+        self.capacity = capacity
+        self.call_seconds = call_seconds
+        self.concurrent_calls = 0
+        self.served_concurrency = []  # concurrent calls seen by each call that was served
+        self.lock = threading.Lock()
+
+    def __call__(self, job):
+        with self.lock:
+            self.concurrent_calls += 1
+            overloaded = self.concurrent_calls > self.capacity
+            if not overloaded:
+                self.served_concurrency.append(self.concurrent_calls)
+        try:
+            if overloaded:
+                raise Exception("Too many concurrent requests (HTTP 429)")
+            time.sleep(self.call_seconds)
+            return job
+        finally:
+            with self.lock:
+                self.concurrent_calls -= 1
+
+
+if __name__ == "__main__":
+    # python adaptive_concurrency.py <fake_capacity> <number_of_jobs>
+    capacity = int(sys.argv[1]) if len(sys.argv) > 1 else 12
+    number_of_jobs = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+
+    controller = AdaptiveConcurrencyController(initial_limit=2, max_limit=40)
+    service = FakeThrottlingService(capacity)
+    limits = []  # the limit after every finished job, AIMD saws between capacity / 2 and capacity
+    pool = ThreadPool(controller.max_limit)
+    failures = run_adaptively(
+        pool,
+        service,
+        range(number_of_jobs),
+        controller,
+        base_backoff_seconds=0.05,
+        on_result=lambda status, result, error: limits.append(controller.limit),
+    )
+    pool.close()
+    pool.join()
+
+    settled = limits[len(limits) // 2 :]  # after the slow start
+    print(
+        f"Fake capacity: {capacity}, limit over the second half: mean {sum(settled) / len(settled):.1f}, max {max(settled)}, final {controller.limit}"
+    )
+    print(
+        f"Concurrent calls served: mean {sum(service.served_concurrency) / len(service.served_concurrency):.1f}, max {max(service.served_concurrency)}"
+    )
+    print(controller.progress_postfix(), "failures:", len(failures))
@@ -11,6 +11,9 @@ import rasterio.features
 import warnings
 from sklearn.linear_model import LinearRegression
 import equations
+import raster_preprocessing
+import joblib
+import insitu_tolerance
 
 
 def get_ratio_from_tif(tif_path, equation_functions):
@@ -23,20 +26,7 @@ def get_ratio_from_tif(tif_path, equation_functions):
         closest_insitu_date = tags["closest_insitu_date"]
         objectid = tags["objectid"]
 
-        bands = src.read()
-
-        # replace all -infs with nan
-        bands[~np.isfinite(bands)] = np.nan
-
-        if (
-            "L2" in tif_path
-        ):  # level 2 data correction https://www.usgs.gov/landsat-missions/landsat-collection-2-surface-reflectance
-            bands = bands * 0.0000275 - 0.2  # operations on nan/inf are still nan/inf
-
-        bands[bands > 0.1] = (
-            np.nan
-        )  # keep array shape but remove high reflectance outliers (clouds)
-        # also this removes acolite outofbound nan values (10^36)
+        bands = raster_preprocessing.read_reflectances(src, tif_path)
 
         list_of_ratio_tuples = []
 
@@ -61,10 +51,15 @@ number_of_equations = len(equations.equation_functions)
 # out_folder = "all_lake_images_three_front_and_back_water_mask_main"
 out_folder = "all_acolite_true_out_rhorc_acolite"
 
+# only use tifs whose scene is within this many days of the insitu sample (None uses all)
+max_days_from_insitu = None
+tifs_to_use = insitu_tolerance.tifs_within_tolerance(out_folder, max_days_from_insitu)
+
 display = False
 
 list_of_results_df_rows = []
 results_reg_eq = []
+equation_models_by_lake = {}  # OBJECTID -> {equation index: fitted regression}
 
 all_X_s_ever_by_equation = list(map(lambda x: [], equations.equation_functions))
 all_true_ln_docs_ever = []
@@ -84,6 +79,8 @@ for subfolder in subfolders:
     tif_folder_path = os.path.join(out_folder, subfolder)
 
     for filename in os.listdir(tif_folder_path):
+        if tifs_to_use is not None and (subfolder, filename) not in tifs_to_use:
+            continue  # outside of the insitu tolerance
         tif_filepath = os.path.join(tif_folder_path, filename)
 
         (
@@ -191,6 +188,7 @@ for subfolder in subfolders:
     # this_results_r2 = []
     results_df_row = {}
     this_results_reg_eq = []
+    this_equation_models = {}
     for i in range(number_of_equations):
         X = input_means_by_equation[i]
 
@@ -215,6 +213,7 @@ for subfolder in subfolders:
         results_df_row[f"equation_i{i}_rmse"] = regression_rmse
         results_df_row[f"equation_i{i}_mae"] = regression_mae
         this_results_reg_eq.append(reg)
+        this_equation_models[i] = reg
 
     proper_lake_name = inspect_shapefile.shp_df[
         inspect_shapefile.shp_df["OBJECTID"] == float(objectid)
@@ -230,6 +229,7 @@ for subfolder in subfolders:
 
     list_of_results_df_rows.append(results_df_row)
     results_reg_eq.append(this_results_reg_eq)
+    equation_models_by_lake[float(objectid)] = this_equation_models
 
 results_df = pd.DataFrame(list_of_results_df_rows)
 
@@ -244,6 +244,17 @@ results_df = results_df[column_order + ["number_truth_values", "OBJECTID", "NAME
 
 results_df.to_csv("results.csv")
 
+# fitted regressions, for predict_doc_maps.py
+alg_name = out_folder.split("_")[-1].upper()  # our convention is last underscore contains alg name
+joblib.dump(
+    {
+        "equation_models_by_lake": equation_models_by_lake,
+        "target": "ln_doc",
+        "alg": alg_name,
+    },
+    f"equation_models_{alg_name}.joblib",
+)
+
 print("Results: \n", results_df)
 
 # Mass apply a set equation to all
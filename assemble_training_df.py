@@ -3,18 +3,19 @@ import rasterio
 import numpy as np
 import pandas as pd
 import os
+import re
+import json
 from matplotlib import pyplot as plt
 from shapely.geometry import Point
 import rasterio.features
 import sys
-
-if len(sys.argv) <= 1:
-    print(
-        "You need to specify which algorithm out folders you are assembling as arguments."
-    )
-    sys.exit(1)
-
+import argparse
+import multiprocessing
 import inspect_shapefile
+import insitu_tolerance
+import raster_preprocessing
+
+band_names = ["443", "483", "561", "655", "865"]
 
 
 def get_bands_from_tif(tif_path):
@@ -26,21 +27,10 @@ def get_bands_from_tif(tif_path):
         x_res = src.res[0]  # same as src.res[1]
         closest_insitu_date = tags["closest_insitu_date"]
         objectid = tags["objectid"]
+        scene_date = tags.get("date")
+        image_index = tags.get("image_index")
 
-        bands = src.read()
-
-        # replace all -infs with nan
-        bands[~np.isfinite(bands)] = np.nan
-
-        if (
-            "L2" in tif_path
-        ):  # level 2 data correction https://www.usgs.gov/landsat-missions/landsat-collection-2-surface-reflectance
-            bands = bands * 0.0000275 - 0.2  # operations on nan/inf are still nan/inf
-
-        bands[bands > 0.1] = (
-            np.nan
-        )  # keep array shape but remove high reflectance outliers (clouds)
-        # also this removes acolite outofbound nan values (10^36)
+        bands = raster_preprocessing.read_reflectances(src, tif_path)
 
         return (
             bands,
@@ -50,11 +40,17 @@ def get_bands_from_tif(tif_path):
             x_res,
             closest_insitu_date,
             objectid,
+            scene_date,
+            image_index,
         )
 
 
-def add_training_entries_from_algorithim_out_folder(out_folder, training_entries):
-    algorithim_name = out_folder.split("_")[-1].upper()
+def get_lake_jobs(out_folder, max_days_from_insitu=None):
+    # one job per (algorithm folder, lake subfolder), so lakes from every folder can share a pool
+    tifs_to_use = insitu_tolerance.tifs_within_tolerance(
+        out_folder, max_days_from_insitu
+    )
+    lake_jobs = []
     subfolders = list(os.listdir(out_folder))
     subfolders.sort()
     for subfolder in subfolders:
@@ -63,98 +59,378 @@ def add_training_entries_from_algorithim_out_folder(out_folder, training_entries
         if subfolder == "rondaxe,_lake_tifs" or subfolder == "otter_lake_tifs":
             continue  # temporary, rondaxe does not have enough pixels around centroid
 
-        tif_folder_path = os.path.join(out_folder, subfolder)
-
-        for filename in os.listdir(tif_folder_path):
-            current_training_entry = {}
-            tif_filepath = os.path.join(tif_folder_path, filename)
-
-            (
-                bands,
-                profile,
-                transform,
-                scale,
-                x_res,
-                closest_insitu_date,
-                objectid,
-            ) = get_bands_from_tif(tif_filepath)
-
-            # matched doc
-            all_doc = inspect_shapefile.truth_data[
-                (inspect_shapefile.truth_data["OBJECTID"] == float(objectid))
-                & (inspect_shapefile.truth_data["DATE_SMP"] == closest_insitu_date)
-            ]["DOC_MG_L"]
-            try:
-                doc = all_doc.item()
-            except ValueError:  # array either has 2+ or 0 items
-                if len(all_doc) > 0:  # means 2+ measurements for that date, take mean
-                    doc = all_doc.mean()
-                else:
-                    raise Exception("No DOC values found for that date.")
-            current_training_entry["doc"] = doc
-
-            # get lat and long
-            centroid_lat = inspect_shapefile.truth_data[
-                (inspect_shapefile.truth_data["OBJECTID"] == float(objectid))
-                & (inspect_shapefile.truth_data["DATE_SMP"] == closest_insitu_date)
-            ]["Lat-Cent"].iloc[
-                0
-            ]  # take first entry, lake centroid lat will be the same for any matched insitu
-            centroid_long = inspect_shapefile.truth_data[
-                (inspect_shapefile.truth_data["OBJECTID"] == float(objectid))
-                & (inspect_shapefile.truth_data["DATE_SMP"] == closest_insitu_date)
-            ]["Lon-Cent"].iloc[
-                0
-            ]  # take first entry, lake centroid long will be the same for any matched insitu
-
-            radius_in_meters = 60
-            circle = Point(centroid_long, centroid_lat).buffer(
-                x_res * (radius_in_meters / float(scale))
-            )  # however many x_res sized pixels needed for buffer of radius at downloaded scale
-
-            outside_circle_mask = rasterio.features.geometry_mask(
-                [circle], bands[0].shape, transform
+        filenames = []
+        for filename in os.listdir(os.path.join(out_folder, subfolder)):
+            if tifs_to_use is not None and (subfolder, filename) not in tifs_to_use:
+                continue  # outside of the insitu tolerance
+            filenames.append(filename)
+        filenames.sort()
+        lake_jobs.append((out_folder, subfolder, filenames))
+    return lake_jobs
+
+
+def get_training_entries_for_lake(lake_job, pixel_arrays=None):
+    # pixel_arrays, if given, gets each entry's (pixels, bands) float32 centroid pixels, in entry order
+    out_folder, subfolder, filenames = lake_job
+    algorithim_name = out_folder.split("_")[-1].upper()
+    tif_folder_path = os.path.join(out_folder, subfolder)
+
+    training_entries = []
+    for filename in filenames:
+        current_training_entry = {}
+        tif_filepath = os.path.join(tif_folder_path, filename)
+
+        (
+            bands,
+            profile,
+            transform,
+            scale,
+            x_res,
+            closest_insitu_date,
+            objectid,
+            scene_date,
+            image_index,
+        ) = get_bands_from_tif(tif_filepath)
+
+        # matched doc
+        all_doc = inspect_shapefile.truth_data[
+            (inspect_shapefile.truth_data["OBJECTID"] == float(objectid))
+            & (inspect_shapefile.truth_data["DATE_SMP"] == closest_insitu_date)
+        ]["DOC_MG_L"]
+        try:
+            doc = all_doc.item()
+        except ValueError:  # array either has 2+ or 0 items
+            if len(all_doc) > 0:  # means 2+ measurements for that date, take mean
+                doc = all_doc.mean()
+            else:
+                raise Exception("No DOC values found for that date.")
+        current_training_entry["doc"] = doc
+
+        # get lat and long
+        centroid_lat = inspect_shapefile.truth_data[
+            (inspect_shapefile.truth_data["OBJECTID"] == float(objectid))
+            & (inspect_shapefile.truth_data["DATE_SMP"] == closest_insitu_date)
+        ]["Lat-Cent"].iloc[
+            0
+        ]  # take first entry, lake centroid lat will be the same for any matched insitu
+        centroid_long = inspect_shapefile.truth_data[
+            (inspect_shapefile.truth_data["OBJECTID"] == float(objectid))
+            & (inspect_shapefile.truth_data["DATE_SMP"] == closest_insitu_date)
+        ]["Lon-Cent"].iloc[
+            0
+        ]  # take first entry, lake centroid long will be the same for any matched insitu
+
+        radius_in_meters = 60
+        circle = Point(centroid_long, centroid_lat).buffer(
+            x_res * (radius_in_meters / float(scale))
+        )  # however many x_res sized pixels needed for buffer of radius at downloaded scale
+
+        outside_circle_mask = rasterio.features.geometry_mask(
+            [circle], bands[0].shape, transform
+        )
+
+        for band in bands:
+            band[outside_circle_mask] = (
+                np.nan
+            )  # arrays store pointer to ratio array, this is okay bc just a mutation
+
+        not_enough_pixels = False
+        for band in bands:
+            valid_pixels = band[np.isfinite(band)]
+            if len(valid_pixels) < 3:
+                not_enough_pixels = True
+
+        if not_enough_pixels:
+            continue
+
+        # now, can take means safely
+        for band_index in range(
+            len(band_names)
+        ):  # in case tif has extra bands we don't care about
+            band = bands[band_index]
+            band_name = band_names[band_index]
+            mean_value = np.nanmean(band)
+            current_training_entry[band_name] = mean_value
+
+        # Recod alg name
+        current_training_entry["alg"] = algorithim_name
+        current_training_entry["lakeid"] = objectid
+        current_training_entry["date"] = scene_date
+        current_training_entry["closest_insitu_date"] = closest_insitu_date
+        current_training_entry["image_index"] = image_index
+        current_training_entry["tif"] = tif_filepath  # not a training_data.csv column
+
+        training_entries.append(current_training_entry)
+        if pixel_arrays is not None:
+            centroid_pixels = bands[: len(band_names), ~outside_circle_mask].T
+            pixel_arrays.append(
+                centroid_pixels[np.all(np.isfinite(centroid_pixels), axis=1)].astype(
+                    np.float32
+                )
             )
 
-            for band in bands:
-                band[outside_circle_mask] = (
-                    np.nan
-                )  # arrays store pointer to ratio array, this is okay bc just a mutation
+    return training_entries
+
+
+def get_training_entries_and_pixels_for_lake(lake_job):
+    pixel_arrays = []
+    training_entries = get_training_entries_for_lake(lake_job, pixel_arrays)
+    return training_entries, pixel_arrays
+
 
-            not_enough_pixels = False
-            for band in bands:
-                valid_pixels = band[np.isfinite(band)]
-                if len(valid_pixels) < 3:
-                    not_enough_pixels = True
+def add_training_entries_from_algorithim_out_folder(
+    out_folder, training_entries, max_days_from_insitu=None
+):
+    for lake_job in get_lake_jobs(out_folder, max_days_from_insitu):
+        training_entries.extend(get_training_entries_for_lake(lake_job))
 
-            if not_enough_pixels:
+
+def get_training_df(training_entries) -> pd.DataFrame:
+    training_df = pd.DataFrame(
+        training_entries,
+        columns=["doc"]
+        + band_names
+        + ["alg", "lakeid", "date", "closest_insitu_date", "image_index"],
+    )
+    # typed columns, so the parquet dataset doesn't store everything as strings
+    training_df["lakeid"] = training_df["lakeid"].astype(float).astype("int64")
+    training_df["date"] = pd.to_datetime(training_df["date"]).dt.date
+    training_df["closest_insitu_date"] = pd.to_datetime(
+        training_df["closest_insitu_date"]
+    ).dt.date
+    training_df[["doc"] + band_names] = training_df[["doc"] + band_names].astype(
+        "float64"
+    )
+    return training_df.sort_values(["alg", "lakeid", "date"]).reset_index(drop=True)
+
+
+def write_pixel_dataset(training_entries, pixel_arrays, pixels_dir):
+    # every valid centroid pixel as one float32 row, .npy so np.load(mmap_mode="r") is zero copy:
+    #   pixels.npy (N, 5) band reflectances, tif_id/lakeid/alg_id/doc.npy (N,) per pixel,
+    #   offsets.npy (tifs + 1,), tif i's pixels are pixels[offsets[i]:offsets[i + 1]],
+    #   tifs.csv one row per tif_id, algs.json the alg_id -> alg name
+    if not os.path.exists(pixels_dir):
+        os.makedirs(pixels_dir)
+
+    algs = sorted(set(training_entry["alg"] for training_entry in training_entries))
+    pixel_counts = np.array([len(pixels) for pixels in pixel_arrays], np.int64)
+    offsets = np.concatenate(([0], np.cumsum(pixel_counts)))
+
+    pixels = np.lib.format.open_memmap(
+        os.path.join(pixels_dir, "pixels.npy"),
+        mode="w+",
+        dtype=np.float32,
+        shape=(int(offsets[-1]), len(band_names)),
+    )
+    for tif_id in range(len(pixel_arrays)):
+        pixels[offsets[tif_id] : offsets[tif_id + 1]] = pixel_arrays[tif_id]
+    pixels.flush()
+    del pixels
+
+    tif_ids = np.arange(len(training_entries), dtype=np.int32)
+    np.save(os.path.join(pixels_dir, "offsets.npy"), offsets)
+    np.save(os.path.join(pixels_dir, "tif_id.npy"), np.repeat(tif_ids, pixel_counts))
+    np.save(
+        os.path.join(pixels_dir, "lakeid.npy"),
+        np.repeat(
+            np.array(
+                [int(float(entry["lakeid"])) for entry in training_entries], np.int64
+            ),
+            pixel_counts,
+        ),
+    )
+    np.save(
+        os.path.join(pixels_dir, "alg_id.npy"),
+        np.repeat(
+            np.array([algs.index(entry["alg"]) for entry in training_entries], np.int8),
+            pixel_counts,
+        ),
+    )
+    np.save(
+        os.path.join(pixels_dir, "doc.npy"),
+        np.repeat(
+            np.array([entry["doc"] for entry in training_entries], np.float32),
+            pixel_counts,
+        ),
+    )
+
+    tifs_df = pd.DataFrame(
+        training_entries,
+        columns=["tif", "alg", "lakeid", "date", "closest_insitu_date", "doc"],
+    )
+    tifs_df.insert(0, "tif_id", tif_ids)
+    tifs_df["pixel_count"] = pixel_counts
+    tifs_df.to_csv(os.path.join(pixels_dir, "tifs.csv"), index=False)
+    with open(os.path.join(pixels_dir, "algs.json"), "w") as f:
+        json.dump(algs, f)
+
+    return int(offsets[-1])
+
+
+def get_scene_id(image_index):
+    # image_index looks like 1_LC08_015029_20210801 (the merge prefixes it), the prefix can differ
+    # between algorithms for the same scene so only the LC08_015029_20210801 part is used to pair
+    match = re.search(r"L[CO]0[89]_\d{6}_\d{8}", str(image_index))
+    return match.group(0) if match else image_index
+
+
+def add_entries_to_paired_rows(paired_rows, training_entries, algs):
+    # hash join on (lakeid, scene date, scene id, insitu date), each alg fills in its own columns of
+    # the row. Two insitu samples matched to the same scene are two rows. Returns how many duplicate
+    # tifs of an already filled (row, alg) were dropped, the one with the first tif path is kept
+    # so the result doesn't depend on which worker finished first.
+    number_dropped = 0
+    for training_entry in training_entries:
+        alg = training_entry["alg"]
+        key = (
+            int(float(training_entry["lakeid"])),
+            training_entry["date"],
+            get_scene_id(training_entry["image_index"]),
+            training_entry["closest_insitu_date"],
+        )
+        if key not in paired_rows:
+            paired_rows[key] = {
+                "lakeid": key[0],
+                "date": key[1],
+                "scene_id": key[2],
+                "doc": training_entry["doc"],
+                "closest_insitu_date": key[3],
+            }
+            for other_alg in algs:
+                paired_rows[key][f"{other_alg}_present"] = False
+        paired_row = paired_rows[key]
+        if paired_row[f"{alg}_present"]:
+            number_dropped += 1  # duplicate tif of the same scene for this alg
+            if training_entry["tif"] >= paired_row[f"{alg}_tif"]:
                 continue
+        paired_row[f"{alg}_present"] = True
+        paired_row[f"{alg}_tif"] = training_entry["tif"]  # not a paired csv column
+        for band_name in band_names:
+            paired_row[f"{alg}_{band_name}"] = training_entry[band_name]
+    return number_dropped
 
-            # now, can take means safely
-            band_names = ["443", "483", "561", "655", "865"]
-            for band_index in range(
-                len(band_names)
-            ):  # in case tif has extra bands we don't care about
-                band = bands[band_index]
-                band_name = band_names[band_index]
-                mean_value = np.nanmean(band)
-                current_training_entry[band_name] = mean_value
 
-            # Recod alg name
-            current_training_entry["alg"] = algorithim_name
-            current_training_entry["lakeid"] = objectid
+def get_paired_df(paired_rows, algs) -> pd.DataFrame:
+    columns = ["lakeid", "date", "scene_id", "doc", "closest_insitu_date"]
+    for alg in algs:
+        columns += [f"{alg}_present"] + [f"{alg}_{band_name}" for band_name in band_names]
+    paired_df = pd.DataFrame(list(paired_rows.values()), columns=columns)
+    for alg in algs:
+        paired_df[f"{alg}_present"] = paired_df[f"{alg}_present"].astype(bool)
+    paired_df["date"] = pd.to_datetime(paired_df["date"]).dt.date
+    paired_df["closest_insitu_date"] = pd.to_datetime(
+        paired_df["closest_insitu_date"]
+    ).dt.date
+    return paired_df.sort_values(
+        ["lakeid", "date", "scene_id", "closest_insitu_date"]
+    ).reset_index(drop=True)
 
-            training_entries.append(current_training_entry)
 
+def write_training_dataset(training_df, dataset_dir):
+    # partitioned by alg then lakeid, e.g. dataset_dir/alg=MAIN/lakeid=298315/*.parquet,
+    # so training can read one algorithm (or a few lakes) without touching the rest.
+    # pd.read_parquet(dataset_dir, filters=[("alg", "=", "MAIN")])
+    training_df.to_parquet(
+        dataset_dir,
+        engine="pyarrow",
+        partition_cols=["alg", "lakeid"],
+        existing_data_behavior="delete_matching",
+        index=False,
+    )
 
-training_entries = []
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "out_folders",
+        nargs="+",
+        help="algorithm out folders to assemble, e.g. all_lake_images_main all_lake_images_L2",
+    )
+    parser.add_argument(
+        "--max-days-from-insitu",
+        type=int,
+        default=None,
+        help="only use tifs whose scene is within this many days of the insitu sample",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="lakes from every out folder are spread across this many processes",
+    )
+    parser.add_argument(
+        "--parquet",
+        default=None,
+        metavar="DATASET_DIR",
+        help="also write a parquet dataset partitioned by alg and lakeid",
+    )
+    parser.add_argument(
+        "--paired",
+        action="store_true",
+        help="also write paired_training_data.csv, one row per (lake, scene, insitu sample) with every alg's band means side by side",
+    )
+    parser.add_argument(
+        "--pixels",
+        default=None,
+        metavar="PIXELS_DIR",
+        help="also write every valid centroid pixel as memory mappable .npy arrays",
+    )
+    args = parser.parse_args()
 
-for folder in sys.argv[1:]:
-    add_training_entries_from_algorithim_out_folder(folder, training_entries)
+    algs = list(
+        dict.fromkeys(folder.split("_")[-1].upper() for folder in args.out_folders)
+    )
+    paired_rows = {}
+    number_of_paired_duplicates = 0
+
+    lake_jobs = []
+    for folder in args.out_folders:
+        lake_jobs.extend(get_lake_jobs(folder, args.max_days_from_insitu))
+
+    training_entries = []
+    pixel_arrays = []  # centroid pixels are only a few per tif, cheap to always collect
+    if args.workers > 1:
+        with multiprocessing.Pool(args.workers) as pool:
+            for lake_training_entries, lake_pixel_arrays in tqdm.tqdm(
+                pool.imap_unordered(get_training_entries_and_pixels_for_lake, lake_jobs),
+                total=len(lake_jobs),
+            ):
+                training_entries.extend(lake_training_entries)
+                pixel_arrays.extend(lake_pixel_arrays)
+                if args.paired:
+                    number_of_paired_duplicates += add_entries_to_paired_rows(
+                        paired_rows, lake_training_entries, algs
+                    )
+    else:
+        for lake_job in tqdm.tqdm(lake_jobs):
+            lake_training_entries, lake_pixel_arrays = (
+                get_training_entries_and_pixels_for_lake(lake_job)
+            )
+            training_entries.extend(lake_training_entries)
+            pixel_arrays.extend(lake_pixel_arrays)
+            if args.paired:
+                number_of_paired_duplicates += add_entries_to_paired_rows(
+                    paired_rows, lake_training_entries, algs
+                )
 
+    training_df = get_training_df(training_entries)
+    print(training_df)
 
-training_df = pd.DataFrame(training_entries)
-print(training_df)
+    training_df.to_csv("training_data.csv", index=False)
 
-training_df.to_csv("training_data.csv", index=False)
+    if args.parquet is not None:
+        write_training_dataset(training_df, args.parquet)
+        print(f"Wrote parquet dataset to {args.parquet}")
+
+    if args.paired:
+        paired_df = get_paired_df(paired_rows, algs)
+        print(
+            f"{len(paired_df)} paired (scene, insitu sample) rows, {paired_df[[f'{alg}_present' for alg in algs]].all(axis=1).sum()} have every alg, {number_of_paired_duplicates} duplicate tifs of a scene dropped"
+        )
+        paired_df.to_csv("paired_training_data.csv", index=False)
+
+    if args.pixels is not None:
+        number_of_pixels = write_pixel_dataset(
+            training_entries, pixel_arrays, args.pixels
+        )
+        print(f"Wrote {number_of_pixels} pixels to {args.pixels}")
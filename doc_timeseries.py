@@ -0,0 +1,205 @@
+import os
+import argparse
+import multiprocessing
+import warnings
+import numpy as np
+import pandas as pd
+import rasterio
+import rasterio.mask
+import tqdm
+from shapely.geometry import Point
+import lake_geometry
+import raster_preprocessing
+import predict_doc_maps
+
+# Per lake DOC time series from the flyover archive (download_all_flyover_lake_images.py): the
+# chosen equation or model is applied to the pixels around each lake's centroid in every tif.
+# Each lake's csv doubles as its checkpoint, tifs already in it are skipped, so rerunning after new
+# flyovers arrive only appends their rows. Rows record the predictor that made them, switching or
+# retraining it recomputes the lake, and tifs of a lake without a fitted regression get no row.
+
+timeseries_columns = [
+    "date",
+    "image_index",
+    "filename",
+    "predicted_ln_doc",
+    "pixel_count",
+    "ln_doc_std",
+    "predictor",
+]
+radius_in_meters = 60
+minimum_pixels = 3  # less than 3 pixels is not good enough to get a mean
+
+
+def get_centroid_ln_doc(tif_path, predictor_key):
+    # None when there is no model for the lake, so the tif is retried once there is one
+    with rasterio.open(tif_path) as src:
+        tags = src.tags()
+        model = predict_doc_maps.get_block_model(tags["objectid"])
+        if model is None:
+            return None
+
+        x_res = src.res[0]  # same as src.res[1]
+        centroid_lat, centroid_long = lake_geometry.get_lake_centroid(tags["objectid"])
+        circle = Point(centroid_long, centroid_lat).buffer(
+            x_res * (radius_in_meters / float(tags["scale"]))
+        )  # however many x_res sized pixels needed for buffer of radius at downloaded scale
+
+        # only reads the window around the circle, not the whole flyover
+        masked_bands, _ = rasterio.mask.mask(src, [circle], crop=True, filled=False)
+        bands = masked_bands.astype(np.float32).filled(np.nan)  # L2 tifs can be integers
+
+    row = {
+        "date": tags.get("date"),
+        "image_index": tags.get("image_index"),
+        "filename": os.path.basename(tif_path),
+        "predicted_ln_doc": np.nan,
+        "pixel_count": 0,
+        "ln_doc_std": np.nan,
+        "predictor": predictor_key,
+    }
+
+    bands = raster_preprocessing.preprocess_reflectances(
+        bands, raster_preprocessing.get_algorithm(tags, tif_path)
+    )
+    features = predict_doc_maps.get_pixel_features(bands)
+    features = features[np.all(np.isfinite(features), axis=1)]
+
+    row["pixel_count"] = len(features)
+    if len(features) >= minimum_pixels:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", category=UserWarning)  # feature names
+            ln_doc = model.predict(features)
+        row["predicted_ln_doc"] = float(np.mean(ln_doc))
+        row["ln_doc_std"] = float(np.std(ln_doc))
+    return row
+
+
+def update_lake_timeseries(args):
+    out_folder, subfolder, timeseries_path = args
+    predictor_key = predict_doc_maps.predictor["key"]
+
+    kept_df = pd.DataFrame(columns=timeseries_columns)
+    rewrite = False
+    if os.path.exists(timeseries_path):
+        done_df = pd.read_csv(timeseries_path)
+        if "predictor" in done_df.columns:  # csvs from before the column are all recomputed
+            kept_df = done_df[done_df["predictor"] == predictor_key]
+        rewrite = (
+            "predictor" not in done_df.columns or len(kept_df) < len(done_df)
+        )  # rows from another predictor are dropped
+    already_done = set(kept_df["filename"])
+
+    rows = []
+    tif_folder_path = os.path.join(out_folder, subfolder)
+    for filename in sorted(os.listdir(tif_folder_path)):
+        if not filename.endswith(".tif") or filename in already_done:
+            continue
+        try:
+            row = get_centroid_ln_doc(os.path.join(tif_folder_path, filename), predictor_key)
+        except (rasterio.errors.RasterioIOError, ValueError) as e:
+            continue  # unreadable tif, or the centroid circle is outside the tif
+        if row is not None:
+            rows.append(row)
+
+    new_rows_df = pd.DataFrame(rows, columns=timeseries_columns)
+    if rewrite:
+        tmp_timeseries_path = timeseries_path + ".tmp"
+        pd.concat([kept_df[timeseries_columns], new_rows_df]).to_csv(
+            tmp_timeseries_path, index=False
+        )
+        os.replace(tmp_timeseries_path, timeseries_path)
+    elif len(rows) > 0:
+        new_rows_df.to_csv(
+            timeseries_path,
+            mode="a",
+            header=not os.path.exists(timeseries_path),
+            index=False,
+        )
+    return subfolder, len(rows)
+
+
+def combine_timeseries(timeseries_dir) -> pd.DataFrame:
+    lake_timeseries_dfs = []
+    for filename in sorted(os.listdir(timeseries_dir)):
+        if not filename.endswith("_timeseries.csv"):
+            continue
+        lake_timeseries_df = pd.read_csv(os.path.join(timeseries_dir, filename))
+        lake_timeseries_df.insert(
+            0, "lake", filename[: -len("_timeseries.csv")]
+        )  # subfolder name
+        lake_timeseries_dfs.append(lake_timeseries_df)
+    if len(lake_timeseries_dfs) == 0:
+        return pd.DataFrame(columns=["lake"] + timeseries_columns)
+    return (
+        pd.concat(lake_timeseries_dfs)
+        .sort_values(["lake", "date"])
+        .reset_index(drop=True)
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "out_folder", help="flyover archive, e.g. all_flyover_of_lakes_main"
+    )
+    parser.add_argument("timeseries_dir", help="per lake time series csvs go here")
+    predictor_group = parser.add_mutually_exclusive_group(required=True)
+    predictor_group.add_argument(
+        "--model", help="trained model, e.g. models/rf_MAIN.joblib"
+    )
+    predictor_group.add_argument(
+        "--equation-models",
+        help="fitted regressions from apply_equations.py, e.g. equation_models_MAIN.joblib",
+    )
+    parser.add_argument("--equation-index", type=int, default=1)
+    parser.add_argument(
+        "--equation-lake",
+        type=int,
+        default=None,
+        help="use this lake's regression for every tif, instead of each lake's own",
+    )
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count())
+    args = parser.parse_args()
+
+    predictor_settings = {
+        "kind": "model" if args.model is not None else "equation",
+        "path": args.model if args.model is not None else args.equation_models,
+        "equation_index": args.equation_index if args.model is None else None,
+        "equation_lake": args.equation_lake if args.model is None else None,
+    }
+
+    if not os.path.exists(args.timeseries_dir):
+        os.makedirs(args.timeseries_dir)
+
+    lake_jobs = []
+    subfolders = list(os.listdir(args.out_folder))
+    subfolders.sort()
+    for subfolder in subfolders:
+        if os.path.isfile(os.path.join(args.out_folder, subfolder)):
+            continue  # this is the log file
+        lake_jobs.append(
+            (
+                args.out_folder,
+                subfolder,
+                os.path.join(args.timeseries_dir, f"{subfolder}_timeseries.csv"),
+            )
+        )
+
+    lake_geometry.get_lake_polygons()  # load the shapefile once, before forking the workers
+    with multiprocessing.Pool(
+        args.workers,
+        initializer=predict_doc_maps.load_predictor,
+        initargs=(predictor_settings,),
+    ) as pool:
+        for subfolder, number_of_new_rows in tqdm.tqdm(
+            pool.imap_unordered(update_lake_timeseries, lake_jobs), total=len(lake_jobs)
+        ):
+            if number_of_new_rows > 0:
+                tqdm.tqdm.write(f"{subfolder}: {number_of_new_rows} new flyovers")
+
+    timeseries_df = combine_timeseries(args.timeseries_dir)
+    timeseries_df.to_csv(
+        os.path.join(args.timeseries_dir, "all_lakes.csv"), index=False
+    )  # not named *_timeseries.csv, so combine_timeseries never reads it back as a lake
+    print(f"{len(timeseries_df)} flyovers across {timeseries_df['lake'].nunique()} lakes")
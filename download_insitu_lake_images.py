@@ -6,6 +6,9 @@ from pprint import pprint
 import multiprocessing
 import random
 import sys
+import output_catalog
+import stage_timing
+from adaptive_concurrency import AdaptiveConcurrencyController, run_adaptively
 
 
 def gen_all_lakes_all_dates_params(project, OUT_DIR, days_before_and_after_insitu: int):
@@ -14,9 +17,10 @@ def gen_all_lakes_all_dates_params(project, OUT_DIR, days_before_and_after_insit
     if not os.path.exists(OUT_DIR):
         os.makedirs(OUT_DIR)
 
-    index_logfile_path = os.path.join(OUT_DIR, "image_indexes_saved.csv")
-    with open(index_logfile_path, "w") as index_logfile:
-        index_logfile.write("image_index\n")
+    catalog_path = output_catalog.catalog_path_for(OUT_DIR)
+    output_catalog.open_catalog(
+        catalog_path
+    ).close()  # create the schema once before the workers start writing
 
     for lake_info in inspect_shapefile.lake_infos_of_interest:
         lake_name = lake_info["NAME"].lower().replace(" ", "_")
@@ -39,7 +43,7 @@ def gen_all_lakes_all_dates_params(project, OUT_DIR, days_before_and_after_insit
             )
             end_date = dates_for_lake[i] + pd.DateOffset(
                 days=days_before_and_after_insitu
-            )  # check for 1, 3, 5 days (this is one day)
+            )  # fetch once with the widest tolerance (e.g. 5), narrower ones (1, 3) are filtered later with insitu_tolerance
 
             start_date_YYYY_MM_DD = str(start_date)[:10]  # faster than strftime
 
@@ -56,7 +60,7 @@ def gen_all_lakes_all_dates_params(project, OUT_DIR, days_before_and_after_insit
                     dates_for_lake[i],
                     30,  # scale
                     False,  # Should visualize
-                    index_logfile_path,  # logfile path for image indexes
+                    catalog_path,  # sqlite catalog every produced tif is recorded in
                 )
             )
 
@@ -66,7 +70,20 @@ def gen_all_lakes_all_dates_params(project, OUT_DIR, days_before_and_after_insit
 def wrapper_export(
     args,
 ):  # this function allows ONE param to be spread onto many params for a function
-    export_raster_main_landsat(*args)
+    try:
+        export_raster_main_landsat(*args)
+    except Exception as e:
+        out_dir, out_filename, project, lakeid, start_date, end_date = args[:6]
+        catalog_path = args[-1]
+        output_catalog.record_job_failure(
+            catalog_path,
+            os.path.join(out_dir, out_filename),
+            lakeid,
+            start_date,
+            end_date,
+            e,
+        )
+        raise
 
 
 if __name__ == "__main__":
@@ -92,7 +109,12 @@ if __name__ == "__main__":
 
     manager = multiprocessing.Manager()
     scale_cache = manager.dict()  # empty by default
-    pool = multiprocessing.Pool(25)
+    spans_dir = stage_timing.enable()  # before the pool forks
+
+    controller = AdaptiveConcurrencyController(initial_limit=10, max_limit=40)
+    pool = multiprocessing.Pool(
+        controller.max_limit
+    )  # the controller decides how many of these are busy at once
 
     all_params_to_pass_in = gen_all_lakes_all_dates_params(
         project, out_dir, days_before_and_after_insitu
@@ -100,10 +122,9 @@ if __name__ == "__main__":
 
     random.shuffle(all_params_to_pass_in)
 
-    # Starmap
-    pool.imap(
-        wrapper_export,
-        tqdm(all_params_to_pass_in, total=len(all_params_to_pass_in)),
-    )
+    failures = run_adaptively(pool, wrapper_export, all_params_to_pass_in, controller)
     pool.close()
     pool.join()
+
+    print(f"{len(failures)} of {len(all_params_to_pass_in)} jobs failed.")
+    stage_timing.write_summary(spans_dir, os.path.join(out_dir, "stage_timings.json"))
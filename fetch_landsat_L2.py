@@ -1,6 +1,7 @@
 # Code originally from https://github.com/leomet07/PredictChlorophyllALibrary
 
 import ee
+import lake_geometry
 import os
 import pandas as pd
 import io
@@ -12,6 +13,10 @@ import sys
 import datetime
 from pprint import pprint
 import matplotlib.pyplot as plt
+import insitu_tolerance
+import output_catalog
+import time
+from stage_timing import timed_stage
 
 ## GLOBAL CONSTANTS FOR THIS PROJECT
 CLOUD_FILTER = 50
@@ -79,6 +84,10 @@ Import assets from gee depending on which lake you want an image of
 
 
 def import_assets(objectid: int, projectName: str) -> ee.FeatureCollection:
+    if lake_geometry.has_local_lake(objectid):
+        return lake_geometry.get_lake_feature_collection(
+            objectid
+        )  # from doc-data, saves filtering the asset on the server
     LakeShp = ee.FeatureCollection(
         f"projects/{projectName}/assets/195-ALTM-ALAP-lakes-withCentroid"
     )
@@ -201,30 +210,48 @@ def get_image_and_date_from_image_collection(coll, index, shp):
     return image, image_index, date
 
 
-def get_raster(start_date, end_date, LakeShp, scale) -> ee.Image:
+def get_raster(start_date, end_date, LakeShp, scale, target_date=None) -> ee.Image:
     date_range = ee.Filter.date(start_date, end_date)
     filter_range = ee.Filter.Or(date_range)
 
-    merged_landsat_image_collection = import_collections(filter_range, LakeShp)
-    merged_landsat_image_collection_len = (
-        merged_landsat_image_collection.size().getInfo()
-    )
+    with timed_stage("import_collections"):
+        merged_landsat_image_collection = import_collections(filter_range, LakeShp)
+    if target_date is not None:
+        # try scenes closest to the insitu date first, so a wide window still picks the
+        # same scene a narrower window would have
+        target = ee.Date(target_date)
+        merged_landsat_image_collection = merged_landsat_image_collection.map(
+            lambda image: image.set(
+                "days_from_target",
+                ee.Date(  # whole calendar days, same as the days_from_insitu tag
+                    ee.Date(image.get("system:time_start")).format("YYYY-MM-dd")
+                )
+                .difference(target, "day")
+                .abs(),
+            )
+        ).sort("days_from_target")
+    with timed_stage("collection_size_getInfo"):
+        merged_landsat_image_collection_len = (
+            merged_landsat_image_collection.size().getInfo()
+        )
 
     if merged_landsat_image_collection_len == 0:
         raise Exception("NO IMAGES FOUND")
 
     for i in range(0, merged_landsat_image_collection_len):
-        image, image_index, date = get_image_and_date_from_image_collection(
-            merged_landsat_image_collection, i, LakeShp
-        )
-
-        min_value = image.reduceRegion(
-            reducer=ee.Reducer.min(),
-            geometry=LakeShp.geometry(),  # or your specific geometry
-            scale=scale,
-            maxPixels=1e9,
-            crs="EPSG:4326",
-        ).getInfo()
+        with timed_stage("image_metadata_getInfo"):
+            image, image_index, date = get_image_and_date_from_image_collection(
+                merged_landsat_image_collection, i, LakeShp
+            )
+
+        with timed_stage("image_validity_getInfo"):
+            min_value = image.reduceRegion(
+                reducer=ee.Reducer.min(),
+                geometry=LakeShp.geometry(),  # or your specific geometry
+                scale=scale,
+                maxPixels=1e9,
+                crs="EPSG:4326",
+            ).getInfo()
 
         if see_if_all_image_bands_valid(min_value):
             return image, image_index, date
@@ -242,22 +269,34 @@ def export_raster_main_landsat_L2(
     insitu_date: str,
     scale: int,
     shouldVisualize: bool = False,
-    index_logfile_path=None,
+    catalog_path=None,
 ):
-    LakeShp = import_assets(lakeid, project)  # get shape of lake
+    fetch_start_time = time.perf_counter()
+    with timed_stage("import_assets"):
+        LakeShp = import_assets(lakeid, project)  # get shape of lake
+    parsed_insitu_date = insitu_tolerance.parse_insitu_date(insitu_date)
     image, image_index, date = get_raster(
-        start_date=start_date, end_date=end_date, LakeShp=LakeShp, scale=scale
+        start_date=start_date,
+        end_date=end_date,
+        LakeShp=LakeShp,
+        scale=scale,
+        target_date=(
+            None
+            if parsed_insitu_date is None
+            else parsed_insitu_date.strftime("%Y-%m-%d")
+        ),
     )
 
-    url = image.getDownloadURL(
-        {
-            "format": "GEO_TIFF",
-            "scale": scale,  #  increasing this makes predictions more blocky but reduces request size (smaller means more resolution tho!)
-            "region": LakeShp.geometry(),
-            "filePerBand": False,
-            "crs": "EPSG:4326",
-        }
-    )
+    with timed_stage("getDownloadURL"):
+        url = image.getDownloadURL(
+            {
+                "format": "GEO_TIFF",
+                "scale": scale,  #  increasing this makes predictions more blocky but reduces request size (smaller means more resolution tho!)
+                "region": LakeShp.geometry(),
+                "filePerBand": False,
+                "crs": "EPSG:4326",
+            }
+        )
 
     if not os.path.exists(out_dir):
         os.makedirs(out_dir)
@@ -267,9 +306,12 @@ def export_raster_main_landsat_L2(
     # download image, and then view metadata with rasterio
     # print("Downloading raster...")
 
-    response = requests.get(url)
-    with open(out_filepath, "wb") as f:
-        f.write(response.content)
+    with timed_stage("http_transfer") as span:
+        response = requests.get(url)
+        response.raise_for_status()  # a 429/503 should be retried, not saved as a tif
+        with open(out_filepath, "wb") as f:
+            f.write(response.content)
+        span["bytes"] = len(response.content)
 
     new_metadata = {
         "date": date,
@@ -280,17 +322,30 @@ def export_raster_main_landsat_L2(
         "image_index": image_index,
         "algorithm": "L2",
     }
-    with rasterio.open(out_filepath, "r+") as dst:
-        dst.update_tags(**new_metadata)
+    days_from_insitu = insitu_tolerance.days_between_scene_and_insitu(
+        date, insitu_date
+    )
+    if days_from_insitu is not None:
+        new_metadata["days_from_insitu"] = days_from_insitu
+    with timed_stage("tag_rewrite"):
+        with rasterio.open(out_filepath, "r+") as dst:
+            dst.update_tags(**new_metadata)
 
     if shouldVisualize:
         print(f"Image saved to {out_filepath}")
         print("Saved image metadata: ", new_metadata)
         visualize(out_filepath)
 
-    if index_logfile_path:
-        with open(index_logfile_path, "a") as index_logfile:
-            index_logfile.write(f"{image_index}\n")
+    if catalog_path:
+        with timed_stage("catalog_write"):
+            output_catalog.record_output(
+                catalog_path,
+                out_filepath,
+                new_metadata,
+                start_date,
+                end_date,
+                fetch_seconds=time.perf_counter() - fetch_start_time,
+            )
 
     return out_filepath
 
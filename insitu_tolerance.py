@@ -0,0 +1,137 @@
+import os
+import sys
+import pandas as pd
+import rasterio
+import output_catalog
+
+# Lets one widest-window insitu fetch (e.g. days_before_and_after_insitu = 5) stand in for
+# narrower ones (1, 3). Every tif records how many days its scene is from the insitu sample,
+# and this index lets the analysis scripts virtually filter to any narrower tolerance.
+
+TOLERANCE_INDEX_FILENAME = "tolerance_index.csv"
+
+
+def parse_insitu_date(insitu_date):
+    # flyover downloads pass "NOT_FETCHING_BY_INSITU_DATE" instead of a real date
+    try:
+        return pd.to_datetime(insitu_date)
+    except (ValueError, TypeError):
+        return None
+
+
+def days_between_scene_and_insitu(scene_date, insitu_date):
+    parsed_insitu_date = parse_insitu_date(insitu_date)
+    if parsed_insitu_date is None:
+        return None
+    return abs(
+        (pd.to_datetime(scene_date).normalize() - parsed_insitu_date.normalize()).days
+    )
+
+
+index_columns = [
+    "subfolder",
+    "filename",
+    "objectid",
+    "date",
+    "closest_insitu_date",
+    "days_from_insitu",
+    "mtime_ns",  # integer nanoseconds, a float mtime doesn't survive the csv round trip exactly
+    "size_bytes",
+]
+
+
+def read_tolerance_row(subfolder, tif_filepath, stat):
+    try:
+        with rasterio.open(tif_filepath) as src:
+            tags = src.tags()
+    except rasterio.errors.RasterioIOError as e:
+        return None
+
+    if "days_from_insitu" in tags:
+        days_from_insitu = int(tags["days_from_insitu"])
+    else:  # tifs fetched before the tag existed
+        days_from_insitu = days_between_scene_and_insitu(
+            tags["date"], tags["closest_insitu_date"]
+        )
+
+    return {
+        "subfolder": subfolder,
+        "filename": os.path.basename(tif_filepath),
+        "objectid": tags["objectid"],
+        "date": tags["date"],
+        "closest_insitu_date": tags["closest_insitu_date"],
+        "days_from_insitu": days_from_insitu,
+        "mtime_ns": stat.st_mtime_ns,
+        "size_bytes": stat.st_size,
+    }
+
+
+def build_tolerance_index(out_folder):
+    # incremental like tif_catalog: only tifs that are new or changed (by mtime and size) are opened,
+    # so tifs added later (e.g. by a resumed acolite run) show up without reopening the rest
+    index_path = os.path.join(out_folder, TOLERANCE_INDEX_FILENAME)
+    indexed = {}
+    if os.path.exists(index_path):
+        old_index_df = pd.read_csv(index_path)
+        if set(index_columns).issubset(
+            old_index_df.columns
+        ):  # older indexes have no (or float) mtimes and are rebuilt
+            for row in old_index_df[index_columns].to_dict("records"):
+                indexed[(row["subfolder"], row["filename"])] = row
+
+    index_rows = []
+    number_read = 0
+    subfolders = list(os.listdir(out_folder))
+    subfolders.sort()
+    for subfolder in subfolders:
+        tif_folder_path = os.path.join(out_folder, subfolder)
+        if os.path.isfile(tif_folder_path):
+            continue  # this is the log file (or this index)
+
+        for filename in sorted(os.listdir(tif_folder_path)):
+            tif_filepath = os.path.join(tif_folder_path, filename)
+            stat = os.stat(tif_filepath)
+            row = indexed.get((subfolder, filename))
+            if row is None or (row["mtime_ns"], row["size_bytes"]) != (
+                stat.st_mtime_ns,
+                stat.st_size,
+            ):
+                row = read_tolerance_row(subfolder, tif_filepath, stat)
+                if row is not None:  # an unreadable tif is retried, but doesn't rewrite the index
+                    number_read += 1
+            if row is not None:
+                index_rows.append(row)
+
+    index_df = pd.DataFrame(index_rows, columns=index_columns)
+    if number_read > 0 or len(index_rows) != len(indexed):
+        index_df.to_csv(index_path, index=False)
+    return index_df
+
+
+def load_tolerance_index(out_folder):
+    return build_tolerance_index(out_folder)  # refreshing an up to date index is a directory walk
+
+
+def tifs_within_tolerance(out_folder, max_days_from_insitu):
+    # returns set of (subfolder, filename), or None when there is nothing to filter by
+    if max_days_from_insitu is None:
+        return None
+
+    catalog_path = output_catalog.catalog_path_for(out_folder)
+    if os.path.exists(catalog_path):  # downloads record their day offsets in the catalog
+        index_df = output_catalog.get_outputs(
+            catalog_path, max_days_from_insitu=max_days_from_insitu
+        )
+    else:  # e.g. acolite out folders, which are not fetched through the catalog
+        index_df = load_tolerance_index(out_folder)
+        index_df = index_df[index_df["days_from_insitu"] <= max_days_from_insitu]
+    return set(zip(index_df["subfolder"], index_df["filename"]))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("python insitu_tolerance.py <out_dir>")
+        sys.exit(1)
+
+    index_df = build_tolerance_index(sys.argv[1])
+    print(index_df["days_from_insitu"].value_counts().sort_index())
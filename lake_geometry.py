@@ -0,0 +1,74 @@
+import os
+import json
+import geopandas
+import ee
+from shapely.geometry import mapping
+
+# Serves lake polygons and bounds from the local copy of the 195-ALTM-ALAP-lakes-withCentroid
+# shapefile (the same one inspect_shapefile loads), so the fetch paths don't have to filter the
+# GEE asset on the server or getInfo the bounds for every job.
+
+shapefile_path = os.path.join("doc-data", "195-ALTM-ALAP-lakes-withCentroid.shp")
+
+lake_polygons_by_objectid = None  # loaded once per process
+lake_names_by_objectid = None
+lake_centroids_by_objectid = None
+lake_feature_collections_by_objectid = {}
+
+
+def get_lake_polygons():
+    global lake_polygons_by_objectid, lake_names_by_objectid, lake_centroids_by_objectid
+    if lake_polygons_by_objectid is None:
+        shp_df = geopandas.read_file(shapefile_path)
+        if shp_df.crs is not None and shp_df.crs.to_epsg() != 4326:
+            shp_df = shp_df.to_crs(epsg=4326)  # everything we fetch is in EPSG:4326
+        lake_polygons_by_objectid = dict(
+            zip(shp_df["OBJECTID"].astype(int), shp_df.geometry)
+        )
+        lake_names_by_objectid = dict(zip(shp_df["OBJECTID"].astype(int), shp_df["NAME"]))
+        lake_centroids_by_objectid = dict(
+            zip(
+                shp_df["OBJECTID"].astype(int),
+                zip(shp_df["Lat-Cent"], shp_df["Lon-Cent"]),
+            )
+        )  # the centroid columns inspect_shapefile.truth_data carries
+    return lake_polygons_by_objectid
+
+
+def has_local_lake(objectid) -> bool:
+    if not os.path.exists(shapefile_path):
+        return False
+    return int(float(objectid)) in get_lake_polygons()
+
+
+def get_lake_polygon(objectid):
+    return get_lake_polygons()[int(float(objectid))]
+
+
+def get_lake_name(objectid):
+    get_lake_polygons()
+    return lake_names_by_objectid[int(float(objectid))]
+
+
+def get_lake_centroid(objectid):
+    get_lake_polygons()
+    return lake_centroids_by_objectid[int(float(objectid))]  # lat, long
+
+
+def get_lake_bounds(objectid):
+    W, S, E, N = get_lake_polygon(objectid).bounds
+    return [S, W, N, E]  # order acolite's "limit" setting uses
+
+
+def get_lake_feature_collection(objectid) -> ee.FeatureCollection:
+    # built client side, a drop-in for filtering the asset by OBJECTID
+    objectid = int(float(objectid))
+    if objectid not in lake_feature_collections_by_objectid:
+        geo_json = json.loads(
+            json.dumps(mapping(get_lake_polygon(objectid)))
+        )  # tuples -> lists
+        lake_geometry = ee.Geometry(geo_json, "EPSG:4326", False)  # planar, like the asset
+        lake_feature_collections_by_objectid[objectid] = ee.FeatureCollection(
+            [ee.Feature(lake_geometry, {"OBJECTID": objectid})]
+        )
+    return lake_feature_collections_by_objectid[objectid]
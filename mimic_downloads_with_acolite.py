@@ -3,15 +3,24 @@ import numpy as np
 import os
 import pandas as pd
 import ee
+import lake_geometry
 import io
 import requests
 import multiprocessing
 import sys
+import argparse
+import functools
+import shutil
+import collections
+import time
+import re
 import datetime
 from pprint import pprint
 import matplotlib.pyplot as plt
 from pprint import pprint
 from rasterio.warp import calculate_default_transform, reproject, Resampling
+import rasterio.transform
+import rasterio.windows
 
 
 sys.path.append(os.path.join(os.getcwd(), "acolite"))
@@ -33,6 +42,10 @@ def open_gee_project(project: str):
 
 
 def import_assets(objectid: int, projectName: str) -> ee.FeatureCollection:
+    if lake_geometry.has_local_lake(objectid):
+        return lake_geometry.get_lake_feature_collection(
+            objectid
+        )  # from doc-data, saves filtering the asset on the server
     LakeShp = ee.FeatureCollection(
         f"projects/{projectName}/assets/195-ALTM-ALAP-lakes-withCentroid"
     )
@@ -50,174 +63,712 @@ import acolite.gee
 
 open_gee_project(project=project)
 
-if len(sys.argv) != 4:
-    print("Pass three directories into this script: ")
-    print(
-        "python mimic_downloads_with_acolite.py <TARGET> <INTERMEDIATE> <TRUE_OUTPUT>"
-    )
+band_names = ["443", "483", "561", "655", "865"]
 
-target_dir = sys.argv[1]
 
-intermediate_storage_dir = os.path.abspath(
-    sys.argv[2]
-)  # needs to be abs path (will be left alone if alr absolute)
+def gen_acolite_jobs(target_dir, true_output_dir):
+    jobs = []
+    failures = []
+    seen_output_files = set()
 
-print("INTER DIR: ", intermediate_storage_dir)
+    subfolders = list(os.listdir(target_dir))
+    subfolders.sort()
+    for subfolder in subfolders:
+        tif_folder_path = os.path.join(target_dir, subfolder)
+        if os.path.isfile(tif_folder_path):
+            continue  # this is the log file
+        if subfolder == "rondaxe,_lake_tifs" or subfolder == "otter_lake_tifs":
+            continue  # temporary, rondaxe does not have enough pixels around centroid
 
-true_output_dir = sys.argv[3]
+        for filename in os.listdir(tif_folder_path):
+            tif_filepath = os.path.join(tif_folder_path, filename)
 
-subfolders = list(os.listdir(target_dir))
-subfolders.sort()
-for subfolder in subfolders:
-    tif_folder_path = os.path.join(target_dir, subfolder)
-    if os.path.isfile(tif_folder_path):
-        continue  # this is the log file
-    if subfolder == "rondaxe,_lake_tifs" or subfolder == "otter_lake_tifs":
-        continue  # temporary, rondaxe does not have enough pixels around centroid
+            try:
+                with rasterio.open(tif_filepath) as src:
+                    tags = src.tags()
+            except rasterio.errors.RasterioIOError as e:
+                failures.append(
+                    {"tif_filepath": tif_filepath, "stage": "read_tags", "error": repr(e)}
+                )
+                continue
 
-    for filename in os.listdir(tif_folder_path):
-        tif_filepath = os.path.join(tif_folder_path, filename)
+            output_file = os.path.join(
+                true_output_dir, subfolder, f"{subfolder}_{tags['date']}_ALL.tif"
+            )
+            if output_file in seen_output_files:
+                continue  # two insitu dates matched the same scene, process it once
+            seen_output_files.add(output_file)
+
+            jobs.append(
+                {
+                    "subfolder": subfolder,
+                    "tif_filepath": tif_filepath,
+                    "tags": tags,
+                    "output_file": output_file,
+                }
+            )
 
-        try:
-            with rasterio.open(tif_filepath) as src:
-                tags = src.tags()
-                date_str = tags["date"]
-                date = pd.to_datetime(date_str)  # satellite date
-                objectid = int(float(tags["objectid"]))
-                start_date = date - pd.DateOffset(days=1)
-                end_date = date + pd.DateOffset(days=1)
-        except rasterio.errors.RasterioIOError as e:
-            continue
-        LakeShp = import_assets(objectid, project)  # get shape of lake
-
-        # @markdown Basic settings
-        isodate_start = str(start_date)
-        isodate_end = str(end_date)
-        sensors = "L8_OLI"  # @param ["L8_OLI"]
-        output_dir = os.path.join(
-            intermediate_storage_dir, f"lake{objectid}_{date_str}"
-        )
+    return jobs, failures
 
-        settings = {}
-        gee_settings = {}
 
-        gee_settings["output"] = output_dir
-        gee_settings["sensors"] = sensors
-        gee_settings["isodate_start"] = isodate_start
-        gee_settings["isodate_end"] = isodate_end
-        gee_settings["strict_subset"] = True
-        gee_settings["run_hybrid_dsf"] = False
-        gee_settings["run_offline_dsf"] = True
+def get_lake_bounds(objectid):
+    if lake_geometry.has_local_lake(objectid):
+        return lake_geometry.get_lake_bounds(objectid)  # no getInfo round trip
 
-        # @markdown L2W parameters
-        settings["l2w_parameters"] = []
-        Rrs = True  # @param {type:"boolean"}
-        if Rrs:
-            settings["l2w_parameters"].append("Rrs_*")
+    LakeShp = import_assets(objectid, project)  # get shape of lake
 
-        rhorc = True  # @param {type:"boolean"}
-        if rhorc:
-            settings["l2w_parameters"].append("rhorc_*")
+    coordinates = LakeShp.geometry().bounds().coordinates().getInfo()[0]
+    lon = [x[0] for x in coordinates]
+    lat = [x[1] for x in coordinates]
+    S, W, N, E = min(lat), min(lon), max(lat), max(lon)
+    return [S, W, N, E]
 
-        custom_l2w_parameters = ""  # @param {type:"string"}
-        if custom_l2w_parameters:
-            settings["l2w_parameters"] += custom_l2w_parameters.split(",")
 
-        settings["l1r_export_geotiff"] = True
-        settings["l2t_export_geotiff"] = True
-        settings["l2r_export_geotiff"] = True
-        settings["l2w_export_geotiff"] = True
-        settings["output_geotiff"] = True
+def run_acolite_for_bounds(date_str, limit, output_dir):
+    date = pd.to_datetime(date_str)  # satellite date
+    start_date = date - pd.DateOffset(days=1)
+    end_date = date + pd.DateOffset(days=1)
 
-        coordinates = LakeShp.geometry().bounds().coordinates().getInfo()[0]
-        lon = [x[0] for x in coordinates]
-        lat = [x[1] for x in coordinates]
-        S, W, N, E = min(lat), min(lon), max(lat), max(lon)
-        gee_settings["limit"] = [S, W, N, E]
+    # @markdown Basic settings
+    isodate_start = str(start_date)
+    isodate_end = str(end_date)
+    sensors = "L8_OLI"  # @param ["L8_OLI"]
 
-        acolite.gee.agh_run(settings=gee_settings, acolite_settings=settings)
+    settings = {}
+    gee_settings = {}
 
-        print("FINISHED DOWNLOADING FOR: ", date)
+    gee_settings["output"] = output_dir
+    gee_settings["sensors"] = sensors
+    gee_settings["isodate_start"] = isodate_start
+    gee_settings["isodate_end"] = isodate_end
+    gee_settings["strict_subset"] = True
+    gee_settings["run_hybrid_dsf"] = False
+    gee_settings["run_offline_dsf"] = True
 
-        # Now combine into one
+    # @markdown L2W parameters
+    settings["l2w_parameters"] = []
+    Rrs = True  # @param {type:"boolean"}
+    if Rrs:
+        settings["l2w_parameters"].append("Rrs_*")
 
-        # find all output files
-        try:
-            output_files = list(
-                filter(
-                    lambda x: ("L2W" in x)
-                    and ("crop_rhorc" in x)
-                    and ("2201.tif" not in x)
-                    and ("1609.tif" not in x),
-                    os.listdir(output_dir),
-                )
-            )
-        except FileNotFoundError as e:
-            continue
+    rhorc = True  # @param {type:"boolean"}
+    if rhorc:
+        settings["l2w_parameters"].append("rhorc_*")
 
-        base_stub = output_files[0]
+    custom_l2w_parameters = ""  # @param {type:"string"}
+    if custom_l2w_parameters:
+        settings["l2w_parameters"] += custom_l2w_parameters.split(",")
 
-        band_names = ["443", "483", "561", "655", "865"]
+    settings["l1r_export_geotiff"] = True
+    settings["l2t_export_geotiff"] = True
+    settings["l2r_export_geotiff"] = True
+    settings["l2w_export_geotiff"] = True
+    settings["output_geotiff"] = True
 
-        output_bands = list(map(lambda x: [], band_names))
-        for index in range(len(band_names)):
-            band_name = band_names[index]
+    gee_settings["limit"] = limit  # S, W, N, E
 
-            input_filename = base_stub[:-7] + band_name + ".tif"
+    acolite.gee.agh_run(settings=gee_settings, acolite_settings=settings)
 
-            input_file = os.path.join(output_dir, input_filename)
+    print("FINISHED DOWNLOADING FOR: ", date)
 
-            new_crs = "EPSG:4326"
-            # reproject raster to project crs
 
-            with rasterio.open(input_file) as src:
-                src_crs = src.crs
-                transform, width, height = calculate_default_transform(
-                    src_crs, new_crs, src.width, src.height, *src.bounds
-                )
-                kwargs = src.meta.copy()
-
-                kwargs.update(
-                    {
-                        "crs": new_crs,
-                        "transform": transform,
-                        "width": width,
-                        "height": height,
-                    }
+def get_lake_output_dir(tags, intermediate_storage_dir):
+    objectid = int(float(tags["objectid"]))
+    return os.path.join(
+        intermediate_storage_dir, f"lake{objectid}_{tags['date']}"
+    )  # one per job, so parallel jobs never share intermediates
+
+
+def run_acolite(tags, intermediate_storage_dir):
+    date_str = tags["date"]
+    objectid = int(float(tags["objectid"]))
+
+    lake_bounds = get_lake_bounds(objectid)
+    output_dir = get_lake_output_dir(tags, intermediate_storage_dir)
+
+    run_acolite_for_bounds(date_str, lake_bounds, output_dir)
+
+    return output_dir, lake_bounds
+
+
+def is_readable_tif(tif_path, expected_count=None):
+    # opening only checks the header, reading the last row catches files cut off by a crash
+    try:
+        with rasterio.open(tif_path) as src:
+            if expected_count is not None and src.count != expected_count:
+                return False
+            src.read(
+                1, window=rasterio.windows.Window(0, src.height - 1, src.width, 1)
+            )
+        return True
+    except rasterio.errors.RasterioError as e:
+        return False
+
+
+def find_rhorc_band_sets(output_dir):
+    # every complete set of five L2W rhorc band files, one per tile ACOLITE wrote (a lake near a
+    # path/row edge can pull in the adjacent row of the same pass). Empty until they are written.
+    if not os.path.exists(output_dir):
+        return []
+
+    # find all output files
+    output_files = list(
+        filter(
+            lambda x: ("L2W" in x)
+            and ("crop_rhorc" in x)
+            and ("2201.tif" not in x)
+            and ("1609.tif" not in x),
+            os.listdir(output_dir),
+        )
+    )
+
+    band_sets = []
+    for base_stub in sorted(set(map(lambda x: x[:-7], output_files))):
+        input_files = list(
+            map(
+                lambda band_name: os.path.join(output_dir, base_stub + band_name + ".tif"),
+                band_names,
+            )
+        )
+        if all(
+            map(
+                lambda input_file: os.path.exists(input_file)
+                and is_readable_tif(input_file),
+                input_files,
+            )
+        ):
+            band_sets.append(input_files)
+    return band_sets
+
+
+def open_rhorc_scene(input_files):
+    # the grid of one band set and the EPSG:4326 grid it is warped onto, computed once per set.
+    # The bands themselves are only read by load_rhorc_bands, once a lake actually needs them.
+    new_crs = "EPSG:4326"
+    with rasterio.open(input_files[0]) as src:
+        transform, width, height = calculate_default_transform(
+            src.crs, new_crs, src.width, src.height, *src.bounds
+        )
+        return {
+            "input_files": input_files,
+            "src_crs": src.crs,
+            "src_transform": src.transform,
+            "src_nodata": src.nodata,
+            "src_shape": (src.height, src.width),
+            "meta": src.meta.copy(),
+            "crs": new_crs,
+            "transform": transform,
+            "width": width,
+            "height": height,
+            "source_bands": None,
+        }
+
+
+def load_rhorc_bands(scene):
+    if scene["source_bands"] is not None:
+        return scene["source_bands"]  # already read for another lake of this scene
+
+    source_bands = np.empty((len(band_names),) + scene["src_shape"], np.float32)
+    for index in range(len(scene["input_files"])):
+        with rasterio.open(scene["input_files"][index]) as src:
+            if src.transform != scene["src_transform"] or src.crs != scene["src_crs"]:
+                raise ValueError(
+                    f"{scene['input_files'][index]} is not on the same grid as the other bands"
                 )
+            src.read(
+                1, out=source_bands[index]
+            )  # each band file for some reason has 1 real band and 2 fake bands written to it, we only care abt the first
+    scene["source_bands"] = source_bands
+    return source_bands
+
+
+def choose_rhorc_scene(scenes, lake_bounds):
+    # the band set whose grid covers the whole lake, a pixel of slack for the edge of the warp
+    S, W, N, E = lake_bounds
+    for scene in scenes:
+        west, south, east, north = rasterio.transform.array_bounds(
+            scene["height"], scene["width"], scene["transform"]
+        )
+        slack = abs(scene["transform"].a)
+        if (
+            W >= west - slack
+            and E <= east + slack
+            and S >= south - slack
+            and N <= north + slack
+        ):
+            return scene
+    raise ValueError(
+        f"lake bounds {lake_bounds} are not inside any of the {len(scenes)} L2W rhorc grids ACOLITE wrote"
+    )
+
+
+def open_rhorc_scenes(output_dir):
+    scenes = list(map(open_rhorc_scene, find_rhorc_band_sets(output_dir)))
+    if len(scenes) == 0:
+        raise FileNotFoundError(
+            f"ACOLITE wrote no complete L2W rhorc bands to {output_dir} (no scene found?)"
+        )
+    return scenes
+
+
+def combine_acolite_bands(scene, tags, output_file, crop_bounds=None, num_threads=4):
+    # scene comes from open_rhorc_scene, so lakes of the same scene share one read of the bands
+    # and one target grid, each one only warps its own window of it
+    source_bands = load_rhorc_bands(scene)
+    transform, width, height = scene["transform"], scene["width"], scene["height"]
+
+    if crop_bounds is not None:  # only warp the part of the scene around the lake
+        S, W, N, E = crop_bounds
+        lake_window = rasterio.windows.from_bounds(W, S, E, N, transform)
+        # floor/ceil by hand, rasterio 1.4 ignores op= in round_offsets/round_lengths and rounds
+        # to nearest, which drops the lake's partial edge column and row
+        col_off = int(np.floor(lake_window.col_off))
+        row_off = int(np.floor(lake_window.row_off))
+        window = rasterio.windows.Window(
+            col_off,
+            row_off,
+            int(np.ceil(lake_window.col_off + lake_window.width)) - col_off,
+            int(np.ceil(lake_window.row_off + lake_window.height)) - row_off,
+        ).intersection(rasterio.windows.Window(0, 0, width, height))
+        transform = rasterio.windows.transform(window, transform)
+        width, height = int(window.width), int(window.height)
+
+    kwargs = scene["meta"].copy()
+    kwargs.update(
+        {
+            "crs": scene["crs"],
+            "transform": transform,
+            "width": width,
+            "height": height,
+            "count": len(band_names),
+            "dtype": "float32",
+        }
+    )
+
+    output_bands = np.zeros(
+        (len(band_names), height, width), np.float32
+    )  # create staging grounds to dump in later
+
+    reproject(  # every band in one multithreaded warp
+        source=source_bands,
+        destination=output_bands,
+        src_transform=scene["src_transform"],
+        src_crs=scene["src_crs"],
+        src_nodata=scene["src_nodata"],
+        dst_transform=transform,
+        dst_crs=scene["crs"],
+        resampling=Resampling.nearest,
+        num_threads=num_threads,
+    )
+
+    if not os.path.exists(os.path.dirname(output_file)):
+        os.makedirs(os.path.dirname(output_file), exist_ok=True)
+
+    tags = dict(tags)
+    tags["algorithm"] = "ACOLITE"
+    with rasterio.open(output_file, "w", **kwargs) as dst:
+        dst.update_tags(**tags)
+        dst.write(output_bands)
+
+    print("\n\nSUCCESSFULLY WROTE AND COMBINED: ", output_file, "\n\n")
+
+
+def get_dir_size(path):
+    total_bytes = 0
+    for root, dirs, files in os.walk(path):
+        for filename in files:
+            try:
+                total_bytes += os.path.getsize(os.path.join(root, filename))
+            except FileNotFoundError as e:
+                continue  # deleted by another job while walking
+    return total_bytes
+
+
+def clean_intermediates(output_dir, cleanup):
+    # cleanup is "none", "compact" (keep only the five L2W rhorc bands, enough for a recombine)
+    # or "all". Only called once the _ALL.tif is written.
+    if cleanup == "none" or not os.path.exists(output_dir):
+        return 0
+
+    files_to_keep = set()
+    if cleanup == "compact":
+        files_to_keep = set(
+            map(
+                os.path.abspath,
+                [
+                    input_file
+                    for band_set in find_rhorc_band_sets(output_dir)
+                    for input_file in band_set
+                ],
+            )
+        )
 
-                output_bands[index] = np.zeros(
-                    (height, width), np.float64
-                )  # create staging grounds to dump in later
-
-                reproject(
-                    source=rasterio.band(
-                        src, 1
-                    ),  # each band file for some reason has 1 real band and 2 fake bands written to it, we only care abt the first
-                    destination=output_bands[index],
-                    src_transform=src.transform,
-                    src_crs=src.crs,
-                    dst_transform=transform,
-                    dst_crs=new_crs,
-                    resampling=Resampling.nearest,
+    bytes_reclaimed = 0
+    for root, dirs, files in os.walk(output_dir, topdown=False):
+        for filename in files:
+            file_path = os.path.abspath(os.path.join(root, filename))
+            if file_path in files_to_keep:
+                continue
+            bytes_reclaimed += os.path.getsize(file_path)
+            os.remove(file_path)
+        for dirname in dirs:
+            try:
+                os.rmdir(os.path.join(root, dirname))
+            except OSError as e:
+                continue  # still holds kept files
+    if cleanup == "all":
+        os.rmdir(output_dir)
+
+    print(f"RECLAIMED {bytes_reclaimed / 1e6:.1f} MB FROM: ", output_dir)
+    return bytes_reclaimed
+
+
+def evict_oldest_intermediates(cached_dir_sizes, bytes_to_free):
+    # cached_dir_sizes is {dir: bytes} of intermediate dirs no running job is using (what
+    # --cleanup compact keeps, failed jobs' dirs, dirs from earlier runs). Oldest first, losing one
+    # only means its scene is run through ACOLITE again if it is ever needed.
+    bytes_freed = 0
+    for cached_dir in sorted(cached_dir_sizes, key=os.path.getmtime):
+        if bytes_freed >= bytes_to_free:
+            break
+        shutil.rmtree(cached_dir, ignore_errors=True)
+        bytes_freed += cached_dir_sizes.pop(cached_dir)
+        print(f"EVICTED {cached_dir} TO STAY UNDER THE INTERMEDIATE BUDGET")
+    return bytes_freed
+
+
+def run_with_disk_budget(
+    pool,
+    workers,
+    process_work_item,
+    work_items,
+    intermediate_storage_dir,
+    get_work_item_dir,
+    max_bytes,
+):
+    # keeps the pool busy, but keeps everything in the intermediate dir under max_bytes: cached
+    # dirs no running job is using are evicted oldest first, and new work pauses while the running
+    # jobs alone are over budget (at least one item always runs, so the budget can never deadlock
+    # the run). Cached dirs are measured once (at the start, or when their job finishes), only the
+    # running jobs' dirs are walked every second.
+    pending = collections.deque(work_items)
+    in_flight = []  # (async_result, intermediate dir)
+    results = []
+    paused = False
+
+    cached_dir_sizes = {}
+    if max_bytes is not None and os.path.exists(intermediate_storage_dir):
+        for dirname in os.listdir(intermediate_storage_dir):
+            cached_dir = os.path.join(intermediate_storage_dir, dirname)
+            if os.path.isdir(cached_dir):
+                cached_dir_sizes[cached_dir] = get_dir_size(cached_dir)
+
+    while pending or in_flight:
+        usage = 0
+        if max_bytes is not None:
+            usage = sum(map(lambda item: get_dir_size(item[1]), in_flight))
+            cached_bytes = sum(cached_dir_sizes.values())
+            if usage + cached_bytes > max_bytes:
+                cached_bytes -= evict_oldest_intermediates(
+                    cached_dir_sizes, usage + cached_bytes - max_bytes
                 )
-        kwargs.update(count=len(band_names))
+            usage += cached_bytes
+        while pending and len(in_flight) < workers:
+            if max_bytes is not None and usage >= max_bytes and len(in_flight) > 0:
+                if not paused:
+                    print(
+                        f"PAUSING NEW JOBS, intermediates use {usage / 1e9:.2f} GB of {max_bytes / 1e9:.2f} GB"
+                    )
+                paused = True
+                break
+            paused = False
+            work_item = pending.popleft()
+            work_item_dir = get_work_item_dir(work_item)
+            cached_dir_sizes.pop(work_item_dir, None)  # in use again (a cache hit), never evicted
+            in_flight.append(
+                (pool.apply_async(process_work_item, (work_item,)), work_item_dir)
+            )
+
+        still_in_flight = []
+        for async_result, work_item_dir in in_flight:
+            if async_result.ready():
+                results.append(async_result.get())
+                if max_bytes is not None and os.path.exists(work_item_dir):
+                    cached_dir_sizes[work_item_dir] = get_dir_size(work_item_dir)
+            else:
+                still_in_flight.append((async_result, work_item_dir))
+        in_flight = still_in_flight
+
+        time.sleep(1)
+    return results
 
-        true_output_dir_with_subfolder = os.path.join(
-            true_output_dir,
-            subfolder,
+
+def process_tif(job, run_settings):
+    tif_filepath = job["tif_filepath"]
+
+    if is_readable_tif(job["output_file"], expected_count=len(band_names)):
+        print("CACHE HIT, ALREADY COMBINED: ", job["output_file"])
+        return {"failures": [], "bytes_reclaimed": 0}
+
+    stage = "acolite"
+    try:
+        output_dir = get_lake_output_dir(
+            job["tags"], run_settings["intermediate_storage_dir"]
+        )
+        lake_bounds = None
+        if len(find_rhorc_band_sets(output_dir)) > 0:
+            print("CACHE HIT, SKIPPING ACOLITE FOR: ", output_dir)
+        else:
+            output_dir, lake_bounds = run_acolite(
+                job["tags"], run_settings["intermediate_storage_dir"]
+            )
+
+        stage = "combine"
+        if lake_bounds is None:
+            lake_bounds = get_lake_bounds(int(float(job["tags"]["objectid"])))
+        combine_acolite_bands(
+            choose_rhorc_scene(open_rhorc_scenes(output_dir), lake_bounds),
+            job["tags"],
+            job["output_file"],
+            crop_bounds=lake_bounds if run_settings["crop_to_lake"] else None,
+            num_threads=run_settings["warp_threads"],
         )
-        if not os.path.exists(true_output_dir_with_subfolder):
-            os.makedirs(true_output_dir_with_subfolder)
+    except Exception as e:
+        return {
+            "failures": [{"tif_filepath": tif_filepath, "stage": stage, "error": repr(e)}],
+            "bytes_reclaimed": 0,
+        }
+
+    try:
+        bytes_reclaimed = clean_intermediates(output_dir, run_settings["cleanup"])
+    except OSError as e:  # the tif is written, report it instead of failing the whole run
+        return {
+            "failures": [{"tif_filepath": tif_filepath, "stage": "cleanup", "error": repr(e)}],
+            "bytes_reclaimed": 0,
+        }
+    return {"failures": [], "bytes_reclaimed": bytes_reclaimed}
+
+
+def get_scene_key(tags):
+    # image_index looks like 1_LC08_015029_20210801 (the merge prefixes it), path/row 015029 is the footprint
+    match = re.search(r"L[CO]0[89]_(\d{6})_\d{8}", tags.get("image_index", ""))
+    path_row = match.group(1) if match else "unknown"
+    return tags["date"], path_row
+
+
+def group_jobs_by_scene(jobs):
+    scene_groups = {}
+    for job in jobs:
+        scene_groups.setdefault(get_scene_key(job["tags"]), []).append(job)
+    return list(scene_groups.values())
+
+
+def get_scene_output_dir(scene_jobs, intermediate_storage_dir):
+    date_str, path_row = get_scene_key(scene_jobs[0]["tags"])
+    return os.path.join(intermediate_storage_dir, f"scene{path_row}_{date_str}")
+
+
+def process_scene_group(scene_jobs, run_settings):
+    # one ACOLITE run over the union of every lake in the scene, then each lake is cropped out of it
+    date_str, path_row = get_scene_key(scene_jobs[0]["tags"])
+    output_dir = get_scene_output_dir(
+        scene_jobs, run_settings["intermediate_storage_dir"]
+    )
 
-        output_file = os.path.join(
-            true_output_dir_with_subfolder, f"{subfolder}_{date_str}_ALL.tif"
+    scene_jobs = list(
+        filter(
+            lambda job: not is_readable_tif(
+                job["output_file"], expected_count=len(band_names)
+            ),
+            scene_jobs,
+        )
+    )
+    if len(scene_jobs) == 0:
+        print("CACHE HIT, ALREADY COMBINED SCENE: ", path_row, date_str)
+        return {"failures": [], "bytes_reclaimed": 0}
+
+    stage = "acolite"
+    try:
+        lake_bounds_by_objectid = {}
+        for job in scene_jobs:
+            objectid = int(float(job["tags"]["objectid"]))
+            if objectid not in lake_bounds_by_objectid:
+                lake_bounds_by_objectid[objectid] = get_lake_bounds(objectid)
+
+        all_lake_bounds = list(lake_bounds_by_objectid.values())
+        union_bounds = [
+            min(map(lambda bounds: bounds[0], all_lake_bounds)),  # S
+            min(map(lambda bounds: bounds[1], all_lake_bounds)),  # W
+            max(map(lambda bounds: bounds[2], all_lake_bounds)),  # N
+            max(map(lambda bounds: bounds[3], all_lake_bounds)),  # E
+        ]
+
+        if len(find_rhorc_band_sets(output_dir)) > 0:
+            print("CACHE HIT, SKIPPING ACOLITE FOR: ", output_dir)
+        else:
+            run_acolite_for_bounds(date_str, union_bounds, output_dir)
+        scenes = open_rhorc_scenes(output_dir)  # grids computed once for every lake below
+    except Exception as e:
+        failures = list(
+            map(
+                lambda job: {
+                    "tif_filepath": job["tif_filepath"],
+                    "stage": stage,
+                    "error": repr(e),
+                },
+                scene_jobs,
+            )
         )
-        tags["algorithm"] = "ACOLITE"
-        with rasterio.open(output_file, "w", **kwargs) as dst:
-            dst.update_tags(**tags)
+        return {"failures": failures, "bytes_reclaimed": 0}
+
+    failures = []
+    for job in scene_jobs:
+        try:
+            lake_bounds = lake_bounds_by_objectid[int(float(job["tags"]["objectid"]))]
+            combine_acolite_bands(
+                choose_rhorc_scene(scenes, lake_bounds),
+                job["tags"],
+                job["output_file"],
+                crop_bounds=lake_bounds,
+                num_threads=run_settings["warp_threads"],
+            )
+        except Exception as e:
+            failures.append(
+                {"tif_filepath": job["tif_filepath"], "stage": "combine", "error": repr(e)}
+            )
+
+    bytes_reclaimed = 0
+    if len(failures) == 0:  # keep the shared scene around to debug failed crops
+        try:
+            bytes_reclaimed = clean_intermediates(output_dir, run_settings["cleanup"])
+        except OSError as e:  # the tifs are written, report it instead of failing the whole run
+            failures = list(
+                map(
+                    lambda job: {
+                        "tif_filepath": job["tif_filepath"],
+                        "stage": "cleanup",
+                        "error": repr(e),
+                    },
+                    scene_jobs,
+                )
+            )
+    return {"failures": failures, "bytes_reclaimed": bytes_reclaimed}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        usage="python mimic_downloads_with_acolite.py <TARGET> <INTERMEDIATE> <TRUE_OUTPUT> [--workers N]"
+    )
+    parser.add_argument("target_dir")
+    parser.add_argument("intermediate_storage_dir")
+    parser.add_argument("true_output_dir")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of ACOLITE scene jobs to run at once",
+    )
+    parser.add_argument(
+        "--warp-threads",
+        type=int,
+        default=4,
+        help="threads used by the single multi-band reprojection of each scene",
+    )
+    parser.add_argument(
+        "--crop-to-lake",
+        action="store_true",
+        help="crop the combined tif to the lake bounds instead of the whole ACOLITE subset",
+    )
+    parser.add_argument(
+        "--group-scenes",
+        action="store_true",
+        help="run ACOLITE once per (date, path/row) scene and crop every lake out of it",
+    )
+    parser.add_argument(
+        "--cleanup",
+        choices=["none", "compact", "all"],
+        default="all",
+        help="what to delete from an intermediate dir once its _ALL.tif is written. compact keeps the five L2W rhorc bands so a recombine can skip ACOLITE, but they add up with every scene, bound them with --max-intermediate-gb",
+    )
+    parser.add_argument(
+        "--max-intermediate-gb",
+        type=float,
+        default=None,
+        help="evict the oldest cached intermediate dirs, then pause new ACOLITE jobs, to keep the intermediate dir under this",
+    )
+    args = parser.parse_args()
+
+    target_dir = args.target_dir
+
+    intermediate_storage_dir = os.path.abspath(
+        args.intermediate_storage_dir
+    )  # needs to be abs path (will be left alone if alr absolute)
+
+    print("INTER DIR: ", intermediate_storage_dir)
 
-            for i in range(len(output_bands)):
-                dst.write(output_bands[i], i + 1)
+    true_output_dir = args.true_output_dir
 
-        print("\n\nSUCCESSFULLY WROTE AND COMBINED: ", output_file, "\n\n")
+    run_settings = {
+        "intermediate_storage_dir": intermediate_storage_dir,
+        "crop_to_lake": args.crop_to_lake,
+        "warp_threads": args.warp_threads,
+        "cleanup": args.cleanup,
+    }
+
+    jobs, failures = gen_acolite_jobs(target_dir, true_output_dir)
+
+    if args.group_scenes:
+        work_items = group_jobs_by_scene(jobs)
+        process_work_item = functools.partial(
+            process_scene_group, run_settings=run_settings
+        )
+        get_work_item_dir = functools.partial(
+            get_scene_output_dir, intermediate_storage_dir=intermediate_storage_dir
+        )
+    else:
+        work_items = jobs
+        process_work_item = functools.partial(
+            process_tif, run_settings=run_settings
+        )
+        get_work_item_dir = lambda job: get_lake_output_dir(
+            job["tags"], intermediate_storage_dir
+        )
+    print(f"{len(work_items)} ACOLITE runs for {len(jobs)} tifs")
+
+    if args.workers > 1 or args.max_intermediate_gb is not None:
+        pool = multiprocessing.Pool(args.workers)
+        work_item_results = run_with_disk_budget(
+            pool,
+            args.workers,
+            process_work_item,
+            work_items,
+            intermediate_storage_dir,
+            get_work_item_dir,
+            (
+                None
+                if args.max_intermediate_gb is None
+                else args.max_intermediate_gb * 1e9
+            ),
+        )
+        pool.close()
+        pool.join()
+    else:  # one job at a time and no budget, nothing to schedule
+        work_item_results = list(map(process_work_item, work_items))
+
+    job_failures = []
+    bytes_reclaimed = 0
+    for work_item_result in work_item_results:
+        job_failures.extend(work_item_result["failures"])
+        bytes_reclaimed += work_item_result["bytes_reclaimed"]
+    failures += job_failures
+    print(f"Reclaimed {bytes_reclaimed / 1e9:.2f} GB of intermediates")
+
+    if not os.path.exists(true_output_dir):
+        os.makedirs(true_output_dir)
+    failures_report_path = os.path.join(true_output_dir, "acolite_failures.csv")
+    pd.DataFrame(failures, columns=["tif_filepath", "stage", "error"]).to_csv(
+        failures_report_path, index=False
+    )
+    print(
+        f"{len(jobs) - len(job_failures)} of {len(jobs)} tifs processed, failures written to {failures_report_path}"
+    )
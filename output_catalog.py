@@ -0,0 +1,169 @@
+import os
+import sqlite3
+import sys
+import pandas as pd
+
+# One catalog per download out dir, written by every fetch worker. WAL mode lets the 25
+# pool workers write concurrently while the analysis scripts read it.
+
+CATALOG_FILENAME = "catalog.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outputs (
+    path TEXT PRIMARY KEY, -- relative to the catalog's folder
+    image_index TEXT NOT NULL,
+    objectid INTEGER NOT NULL,
+    date TEXT NOT NULL, -- satellite scene date
+    closest_insitu_date TEXT,
+    days_from_insitu INTEGER,
+    algorithm TEXT NOT NULL,
+    scale INTEGER NOT NULL,
+    size_bytes INTEGER NOT NULL,
+    fetch_seconds REAL,
+    created_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+CREATE INDEX IF NOT EXISTS outputs_by_lake_date ON outputs (objectid, date);
+CREATE INDEX IF NOT EXISTS outputs_by_algorithm ON outputs (algorithm, objectid, date);
+CREATE INDEX IF NOT EXISTS outputs_by_image_index ON outputs (image_index);
+
+CREATE TABLE IF NOT EXISTS jobs (
+    path TEXT PRIMARY KEY, -- relative to the catalog's folder
+    objectid INTEGER NOT NULL,
+    start_date TEXT NOT NULL,
+    end_date TEXT NOT NULL,
+    status TEXT NOT NULL, -- "done" or "failed"
+    error TEXT,
+    updated_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+CREATE INDEX IF NOT EXISTS jobs_by_status ON jobs (status);
+"""
+
+
+def catalog_path_for(out_dir):
+    return os.path.join(out_dir, CATALOG_FILENAME)
+
+
+def open_catalog(catalog_path):
+    connection = sqlite3.connect(
+        catalog_path, timeout=60, isolation_level=None
+    )  # transactions are started explicitly below
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def _relative_path(catalog_path, path):
+    return os.path.relpath(path, os.path.dirname(os.path.abspath(catalog_path)))
+
+
+def record_output(
+    catalog_path, out_filepath, metadata, start_date, end_date, fetch_seconds=None
+):
+    relative_path = _relative_path(catalog_path, out_filepath)
+    connection = open_catalog(catalog_path)
+    try:
+        connection.execute("BEGIN IMMEDIATE")  # take the write lock up front
+        connection.execute(
+            """INSERT OR REPLACE INTO outputs (path, image_index, objectid, date, closest_insitu_date,
+            days_from_insitu, algorithm, scale, size_bytes, fetch_seconds)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+            (
+                relative_path,
+                metadata["image_index"],
+                int(metadata["objectid"]),
+                metadata["date"],
+                str(metadata["closest_insitu_date"]),
+                metadata.get("days_from_insitu"),
+                metadata["algorithm"],
+                int(metadata["scale"]),
+                os.path.getsize(out_filepath),
+                fetch_seconds,
+            ),
+        )
+        connection.execute(
+            """INSERT OR REPLACE INTO jobs (path, objectid, start_date, end_date, status, error)
+            VALUES (?, ?, ?, ?, 'done', NULL)""",
+            (
+                relative_path,
+                int(metadata["objectid"]),
+                str(start_date),
+                str(end_date),
+            ),
+        )
+        connection.execute("COMMIT")
+    except Exception:
+        connection.execute("ROLLBACK")
+        raise
+    finally:
+        connection.close()
+
+
+def record_job_failure(catalog_path, out_filepath, objectid, start_date, end_date, error):
+    connection = open_catalog(catalog_path)
+    try:
+        connection.execute(
+            """INSERT OR REPLACE INTO jobs (path, objectid, start_date, end_date, status, error)
+            VALUES (?, ?, ?, ?, 'failed', ?)""",
+            (
+                _relative_path(catalog_path, out_filepath),
+                int(objectid),
+                str(start_date),
+                str(end_date),
+                str(error),
+            ),
+        )
+    finally:
+        connection.close()
+
+
+def get_outputs(
+    catalog_path, objectid=None, algorithm=None, max_days_from_insitu=None
+) -> pd.DataFrame:
+    conditions = []
+    params = []
+    if objectid is not None:
+        conditions.append("objectid = ?")
+        params.append(int(float(objectid)))
+    if algorithm is not None:
+        conditions.append("algorithm = ?")
+        params.append(algorithm)
+    if max_days_from_insitu is not None:
+        conditions.append("days_from_insitu <= ?")
+        params.append(max_days_from_insitu)
+
+    query = "SELECT * FROM outputs"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += " ORDER BY objectid, date"
+
+    connection = open_catalog(catalog_path)
+    try:
+        outputs_df = pd.read_sql_query(query, connection, params=params)
+    finally:
+        connection.close()
+
+    outputs_df["subfolder"] = outputs_df["path"].map(os.path.dirname)
+    outputs_df["filename"] = outputs_df["path"].map(os.path.basename)
+    outputs_df["path"] = outputs_df["path"].map(
+        lambda path: os.path.join(os.path.dirname(os.path.abspath(catalog_path)), path)
+    )
+    return outputs_df
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("python output_catalog.py <out_dir>")
+        sys.exit(1)
+
+    catalog_path = catalog_path_for(sys.argv[1])
+    outputs_df = get_outputs(catalog_path)
+    print(outputs_df)
+
+    connection = open_catalog(catalog_path)
+    print(
+        pd.read_sql_query(
+            "SELECT status, COUNT(*) AS jobs FROM jobs GROUP BY status", connection
+        )
+    )
+    connection.close()
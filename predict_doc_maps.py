@@ -0,0 +1,208 @@
+import os
+import argparse
+import multiprocessing
+import warnings
+import joblib
+import numpy as np
+import rasterio
+import tqdm
+import equations
+import raster_preprocessing
+
+# Applies a fitted equation regression (apply_equations.py) or a trained model (train_models.py)
+# to every pixel of every lake tif, writing DOC (mg/L) maps. Each tif is streamed one output block
+# at a time, so memory is bounded by the block size rather than by the size of the lake.
+
+band_names = ["443", "483", "561", "655", "865"]
+
+predictor = None  # set per worker by load_predictor
+
+
+def get_predictor_key(predictor_settings):
+    # which predictor made an output, the file's mtime changes when it is retrained in place
+    return "|".join(
+        [
+            predictor_settings["kind"],
+            os.path.basename(predictor_settings["path"]),
+            str(int(os.path.getmtime(predictor_settings["path"]))),
+            str(predictor_settings["equation_index"]),
+            str(predictor_settings["equation_lake"]),
+        ]
+    )
+
+
+def load_predictor(predictor_settings):
+    global predictor
+    predictor = dict(predictor_settings)
+    predictor["key"] = get_predictor_key(predictor_settings)
+    predictor["saved"] = joblib.load(predictor_settings["path"])
+
+
+def get_block_model(objectid):
+    if predictor["kind"] == "model":
+        return predictor["saved"]["model"]
+
+    equation_models_by_lake = predictor["saved"]["equation_models_by_lake"]
+    lake_to_use = (
+        float(predictor["equation_lake"])
+        if predictor["equation_lake"] is not None
+        else float(objectid)  # each lake's own regression
+    )
+    return equation_models_by_lake.get(lake_to_use, {}).get(predictor["equation_index"])
+
+
+def get_pixel_features(bands):
+    # (pixels, features) for the chosen predictor, from already masked bands
+    if predictor["kind"] == "model":
+        return bands[: len(band_names)].reshape(len(band_names), -1).T
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        equation_inputs = equations.equation_functions[predictor["equation_index"]](
+            bands
+        )
+    return np.stack([np.ravel(subratio) for subratio in equation_inputs], axis=1)
+
+
+def predict_doc_map(args):
+    tif_path, out_path, block_size = args
+
+    with rasterio.open(tif_path) as src:
+        tags = src.tags()
+        model = get_block_model(tags["objectid"])
+        if model is None:
+            return tif_path, "no fitted regression for this lake"
+
+        profile = src.profile
+        profile.update(
+            count=1,
+            dtype="float32",
+            nodata=np.nan,
+            compress="deflate",
+            predictor=3,  # floating point predictor, DOC maps are smooth
+            tiled=True,
+            blockxsize=block_size,
+            blockysize=block_size,
+        )
+
+        tmp_out_path = out_path + ".tmp"
+        block_buffer = np.empty((src.count, block_size, block_size), np.float32)
+        block_mask = np.empty(block_buffer.shape, bool)
+        with rasterio.open(tmp_out_path, "w", **profile) as dst:
+            for _, window in dst.block_windows(1):
+                full_block = (window.height, window.width) == (block_size, block_size)
+                bands = raster_preprocessing.read_reflectances(
+                    src,
+                    tif_path,
+                    window=window,
+                    out=block_buffer if full_block else None,  # edge blocks are smaller
+                    mask=block_mask if full_block else None,
+                )
+                features = get_pixel_features(bands)
+                valid_pixels = np.all(np.isfinite(features), axis=1)
+
+                doc_block = np.full(features.shape[0], np.nan, np.float32)
+                if np.any(valid_pixels):
+                    with warnings.catch_warnings():
+                        warnings.simplefilter("ignore", category=UserWarning)  # feature names
+                        ln_doc = model.predict(features[valid_pixels])
+                    doc_block[valid_pixels] = np.exp(ln_doc)  # models predict ln doc
+
+                dst.write(doc_block.reshape(window.height, window.width), 1, window=window)
+
+            dst.update_tags(**tags)
+            dst.update_tags(
+                units="DOC_MG_L",
+                doc_predictor=predictor["kind"],
+                doc_predictor_path=os.path.basename(predictor["path"]),
+                doc_equation_index=str(predictor["equation_index"]),
+                doc_equation_lake=str(predictor["equation_lake"]),
+                doc_predictor_key=predictor["key"],
+            )
+        os.replace(tmp_out_path, out_path)  # never leave a half written map behind
+
+    return tif_path, None
+
+
+def is_up_to_date(out_path, tif_path, predictor_key):
+    # made from this version of the tif, by this version of the predictor
+    if not os.path.exists(out_path) or os.path.getmtime(out_path) < os.path.getmtime(
+        tif_path
+    ):
+        return False
+    try:
+        with rasterio.open(out_path) as dst:
+            return dst.tags().get("doc_predictor_key") == predictor_key
+    except rasterio.errors.RasterioIOError as e:
+        return False
+
+
+def get_prediction_jobs(out_folder, maps_folder, block_size, predictor_key):
+    jobs = []
+    subfolders = list(os.listdir(out_folder))
+    subfolders.sort()
+    for subfolder in subfolders:
+        if os.path.isfile(os.path.join(out_folder, subfolder)):
+            continue  # this is the log file
+        if not os.path.exists(os.path.join(maps_folder, subfolder)):
+            os.makedirs(os.path.join(maps_folder, subfolder))
+        for filename in sorted(os.listdir(os.path.join(out_folder, subfolder))):
+            if not filename.endswith(".tif"):
+                continue
+            tif_path = os.path.join(out_folder, subfolder, filename)
+            out_path = os.path.join(maps_folder, subfolder, filename)
+            if is_up_to_date(out_path, tif_path, predictor_key):
+                continue  # already predicted, and by the same predictor
+            jobs.append((tif_path, out_path, block_size))
+    return jobs
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("out_folder", help="algorithm out folder of lake tifs")
+    parser.add_argument("maps_folder", help="DOC maps are written here, same layout")
+    predictor_group = parser.add_mutually_exclusive_group(required=True)
+    predictor_group.add_argument(
+        "--model", help="trained model, e.g. models/rf_MAIN.joblib"
+    )
+    predictor_group.add_argument(
+        "--equation-models",
+        help="fitted regressions from apply_equations.py, e.g. equation_models_MAIN.joblib",
+    )
+    parser.add_argument("--equation-index", type=int, default=1)
+    parser.add_argument(
+        "--equation-lake",
+        type=int,
+        default=None,
+        help="use this lake's regression for every tif, instead of each lake's own",
+    )
+    parser.add_argument("--block-size", type=int, default=256)
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count())
+    args = parser.parse_args()
+
+    predictor_settings = {
+        "kind": "model" if args.model is not None else "equation",
+        "path": args.model if args.model is not None else args.equation_models,
+        "equation_index": args.equation_index if args.model is None else None,
+        "equation_lake": args.equation_lake if args.model is None else None,
+    }
+
+    jobs = get_prediction_jobs(
+        args.out_folder,
+        args.maps_folder,
+        args.block_size,
+        get_predictor_key(predictor_settings),
+    )
+    print(f"{len(jobs)} tifs to predict")
+
+    skipped = []
+    with multiprocessing.Pool(
+        args.workers, initializer=load_predictor, initargs=(predictor_settings,)
+    ) as pool:
+        for tif_path, reason in tqdm.tqdm(
+            pool.imap_unordered(predict_doc_map, jobs), total=len(jobs)
+        ):
+            if reason is not None:
+                skipped.append((tif_path, reason))
+
+    for tif_path, reason in skipped:
+        print(f"Skipped {tif_path}: {reason}")
@@ -1,89 +1,38 @@
 # Libraries
+import os
+import argparse
+import multiprocessing
+import numpy as np
 import matplotlib.pyplot as plt
 import pandas as pd
 from math import pi
-import inspect_shapefile
-import apply_equations
+import equations
 
+number_of_equations = len(equations.equation_functions)
+categories = ["r2", "rmse", "mae"]
 
-def df_with_normalization_across_ten_eqs_by_lake(df, lakeid, categories):
-    # filter df to this lake
-    only_lake_df = df[df["OBJECTID"] == float(lakeid)]
-    only_lake_df_index = only_lake_df.index
 
+def df_with_normalization_across_eqs_by_lake(df, categories, number_of_equations):
+    # min-max scale each lake's row across the equations, for every category at once
+    df = df.copy()
     for category in categories:
         columns_of_interest = list(
             map(
                 lambda equation_index: f"equation_i{equation_index}_{category}",
-                range(10),
+                range(number_of_equations),
             )
         )
-        only_values_of_interest = only_lake_df[columns_of_interest]
-
-        scaled_only_values_of_interest = only_values_of_interest.apply(
-            lambda row: (row - row.min()) / (row.max() - row.min()), axis=1
-        )
-        scaled_only_values_of_interest = scaled_only_values_of_interest.values.tolist()[
-            0
-        ]
-
-        for i in range(len(scaled_only_values_of_interest)):
-            df.loc[only_lake_df_index, columns_of_interest[i]] = (
-                scaled_only_values_of_interest[i]
-            )
+        values = df[columns_of_interest].to_numpy(dtype=float)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            row_min = np.nanmin(values, axis=1, keepdims=True)
+            row_max = np.nanmax(values, axis=1, keepdims=True)
+            df[columns_of_interest] = (values - row_min) / (row_max - row_min)
 
     return df
 
 
-def plot_lake(ax, df, lakeid, equation_index, columns_to_plot, fill_color):
-    lake_row = df[df["OBJECTID"] == float(lakeid)]
-    lake_row = lake_row[columns_to_plot]
-
-    values = lake_row.values.tolist()[0]
-
-    # add first value back so polygon loops around
-    values += values[0:1]
-
-    ax.plot(angles, values, linewidth=2, label=f"Equation Index {equation_index}")
-    ax.fill(angles, values, alpha=0.1)
-
-
-# for a specific lake
-alg_name = apply_equations.out_folder.split("_")[
-    -1
-].upper()  # our convention is last underscore contains alg name
-
-number_of_subplots = 4
-num_rows = 2
-num_cols = number_of_subplots // num_rows
-fig, axs = plt.subplots(
-    nrows=num_rows, ncols=num_cols, subplot_kw={"projection": "polar"}
-)
-
-lakeids_to_graph = [298315, 298126, 298351, 298091]
-subplot_index = 0
-for lakeid in lakeids_to_graph:
-    ax = axs[subplot_index // num_cols, subplot_index % num_cols]
-
-    # -------------------------- Radar plot ---------------------------------
-    # number of variable
-    categories = ["r2", "rmse", "mae"]
+def setup_radar_axes(ax, angles):
     N = len(categories)
-    categories_to_normalize = ["r2", "rmse", "mae"]  # try not using r2 here
-
-    df = df_with_normalization_across_ten_eqs_by_lake(
-        apply_equations.results_df, lakeid, categories_to_normalize
-    )
-
-    lakename = df[df["OBJECTID"] == lakeid]["NAME"].iloc[0]
-    number_of_truth_values = df[df["OBJECTID"] == lakeid]["number_truth_values"].iloc[0]
-    print(f"{lakename} has {number_of_truth_values} values.")
-
-    # What will be the angle of each axis in the plot? (we divide the plot / number of variable)
-    angles = [n / float(N) * 2 * pi for n in range(N)]
-    angles += angles[:1]
-
-    # Initialise the spider plot
 
     # If you want the first axis to be on top:
     ax.set_theta_offset(pi / 2)
@@ -98,19 +47,129 @@ for lakeid in lakeids_to_graph:
     ax.set_yticks([0, 0.5, 1], labels=["0.1", "0.5", "1.0"], color="grey", size=7)
     ax.set_ylim(0, 1)
 
+
+def plot_lake(ax, lake_row, angles):
     # plot every equation
-    for equation_index in range(10):
+    for equation_index in range(number_of_equations):
         columns_to_plot = list(
             map(lambda category: f"equation_i{equation_index}_{category}", categories)
         )
-        plot_lake(ax, df, lakeid, equation_index, columns_to_plot, "r")
+        values = lake_row[columns_to_plot].tolist()
+
+        # add first value back so polygon loops around
+        values += values[0:1]
 
-    ax.set_title(f"{lakename}")
+        ax.plot(angles, values, linewidth=2, label=f"Equation Index {equation_index}")
+        ax.fill(angles, values, alpha=0.1)
 
-    if subplot_index == (number_of_subplots - 1):
-        handles, labels = ax.get_legend_handles_labels()
-        fig.legend(handles, labels, loc="upper right")
 
-    subplot_index += 1
-plt.suptitle(f"{alg_name} performance")
-plt.show()
+def get_angles():
+    # What will be the angle of each axis in the plot? (we divide the plot / number of variable)
+    N = len(categories)
+    angles = [n / float(N) * 2 * pi for n in range(N)]
+    angles += angles[:1]
+    return angles
+
+
+def render_lake_radar(args):
+    lake_row, alg_name, plot_path = args
+    angles = get_angles()
+
+    fig, ax = plt.subplots(subplot_kw={"projection": "polar"})
+    setup_radar_axes(ax, angles)
+    plot_lake(ax, lake_row, angles)
+    ax.set_title(f"{lake_row['NAME']} ({int(lake_row['number_truth_values'])} values)")
+    fig.legend(*ax.get_legend_handles_labels(), loc="upper right", fontsize=6)
+    fig.suptitle(f"{alg_name} performance")
+
+    fig.savefig(plot_path)
+    plt.close(fig)
+    return plot_path
+
+
+def render_all_lakes(results_csvs_by_alg, out_dir, workers):
+    render_jobs = []
+    for alg_name, results_csv in results_csvs_by_alg.items():
+        results_df = pd.read_csv(results_csv, index_col=0)
+        normalized_df = df_with_normalization_across_eqs_by_lake(
+            results_df, categories, number_of_equations
+        )
+
+        alg_out_dir = os.path.join(out_dir, alg_name)
+        if not os.path.exists(alg_out_dir):
+            os.makedirs(alg_out_dir)
+
+        for _, lake_row in normalized_df.iterrows():
+            plot_path = os.path.join(alg_out_dir, f"{int(lake_row['OBJECTID'])}.png")
+            render_jobs.append((lake_row, alg_name, plot_path))
+
+    with multiprocessing.Pool(workers) as pool:
+        for plot_path in pool.imap_unordered(render_lake_radar, render_jobs):
+            print("Rendered:", plot_path)
+
+
+def show_lakes(lakeids_to_graph):
+    import apply_equations  # runs the regressions, only needed for the interactive plot
+
+    # for a specific lake
+    alg_name = apply_equations.out_folder.split("_")[
+        -1
+    ].upper()  # our convention is last underscore contains alg name
+
+    df = df_with_normalization_across_eqs_by_lake(
+        apply_equations.results_df, categories, number_of_equations
+    )
+    angles = get_angles()
+
+    number_of_subplots = len(lakeids_to_graph)
+    num_rows = 2
+    num_cols = int(np.ceil(number_of_subplots / num_rows))
+    fig, axs = plt.subplots(
+        nrows=num_rows,
+        ncols=num_cols,
+        subplot_kw={"projection": "polar"},
+        squeeze=False,
+    )
+
+    subplot_index = 0
+    for lakeid in lakeids_to_graph:
+        ax = axs[subplot_index // num_cols, subplot_index % num_cols]
+        lake_row = df[df["OBJECTID"] == float(lakeid)].iloc[0]
+
+        lakename = lake_row["NAME"]
+        number_of_truth_values = lake_row["number_truth_values"]
+        print(f"{lakename} has {number_of_truth_values} values.")
+
+        setup_radar_axes(ax, angles)
+        plot_lake(ax, lake_row, angles)
+        ax.set_title(f"{lakename}")
+
+        if subplot_index == (number_of_subplots - 1):
+            handles, labels = ax.get_legend_handles_labels()
+            fig.legend(handles, labels, loc="upper right")
+
+        subplot_index += 1
+    plt.suptitle(f"{alg_name} performance")
+    plt.show()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--results",
+        nargs="+",
+        metavar="ALG=RESULTS_CSV",
+        help="render every lake of each results.csv (from apply_equations.py) to image files, e.g. ACOLITE=results_acolite.csv",
+    )
+    parser.add_argument("--out-dir", default="radar_plots")
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count())
+    args = parser.parse_args()
+
+    if args.results:
+        plt.switch_backend("Agg")  # no windows, workers only write files
+        results_csvs_by_alg = dict(
+            alg_and_path.split("=", 1) for alg_and_path in args.results
+        )
+        render_all_lakes(results_csvs_by_alg, args.out_dir, args.workers)
+    else:
+        show_lakes([298315, 298126, 298351, 298091])
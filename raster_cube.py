@@ -0,0 +1,193 @@
+import os
+import json
+import argparse
+import multiprocessing
+import numpy as np
+import rasterio
+import rasterio.warp
+import rasterio.windows
+from rasterio.transform import Affine
+import tqdm
+import raster_preprocessing
+import tif_catalog
+
+# Packs each lake's tifs (per algorithm folder) into one (time, band, y, x) float32 .npy cube, already
+# through raster_preprocessing.read_reflectances, next to a json sidecar of dates, tags and the grid.
+# Time is the outer axis so each scene is one contiguous block, and np.load(mmap_mode="r") means a
+# date range or window of a lake is a slice of the mapped file instead of thousands of tif opens.
+
+number_of_bands = 5
+
+
+def get_algorithm_name(out_folder):
+    return os.path.normpath(out_folder).split("_")[
+        -1
+    ].upper()  # our convention is last underscore contains alg name
+
+
+def get_cube_paths(cube_root, alg, subfolder):
+    cube_dir = os.path.join(cube_root, alg)
+    return (
+        os.path.join(cube_dir, f"{subfolder}.npy"),
+        os.path.join(cube_dir, f"{subfolder}.json"),
+    )
+
+
+def get_reference_grid(tif_paths):
+    # the grid most of the lake's tifs already share, everything else is warped onto it
+    grids = {}
+    for tif_path in tif_paths:
+        with rasterio.open(tif_path) as src:
+            grid = (src.height, src.width, tuple(src.transform)[:6], src.crs.to_string())
+        grids[grid] = grids.get(grid, 0) + 1
+    return max(grids, key=grids.get)
+
+
+def build_lake_cube(args):
+    out_folder, subfolder, lake_tifs, cube_root = args
+    alg = get_algorithm_name(out_folder)
+    cube_path, sidecar_path = get_cube_paths(cube_root, alg, subfolder)
+
+    sources = [
+        {"filename": os.path.basename(path), "mtime": mtime, "size_bytes": size_bytes}
+        for path, mtime, size_bytes in zip(
+            lake_tifs["path"], lake_tifs["mtime"], lake_tifs["size_bytes"]
+        )
+    ]
+    if os.path.exists(sidecar_path) and os.path.exists(cube_path):
+        with open(sidecar_path, "r") as f:
+            if json.load(f)["sources"] == sources:
+                return subfolder, False  # no tif added, removed or changed
+
+    height, width, transform, crs = get_reference_grid(lake_tifs["path"])
+    transform = Affine(*transform)
+
+    tmp_cube_path = cube_path + ".tmp.npy"
+    cube = np.lib.format.open_memmap(
+        tmp_cube_path,
+        mode="w+",
+        dtype=np.float32,
+        shape=(len(lake_tifs), number_of_bands, height, width),
+    )
+    tags_by_time = []
+    scene_mask = np.empty((number_of_bands, height, width), bool)  # reused by every scene
+    for time_index, tif_path in enumerate(lake_tifs["path"]):
+        with rasterio.open(tif_path) as src:
+            tags_by_time.append(src.tags())
+            indexes = list(range(1, number_of_bands + 1))
+            if (src.height, src.width) == (height, width) and src.transform == transform:
+                # decoded and preprocessed straight into the mapped cube
+                raster_preprocessing.read_reflectances(
+                    src, tif_path, indexes=indexes, out=cube[time_index], mask=scene_mask
+                )
+            else:
+                bands = raster_preprocessing.read_reflectances(
+                    src, tif_path, indexes=indexes
+                )
+                cube[time_index] = np.nan
+                rasterio.warp.reproject(
+                    bands,
+                    cube[time_index],
+                    src_transform=src.transform,
+                    src_crs=src.crs,
+                    dst_transform=transform,
+                    dst_crs=crs,
+                    src_nodata=np.nan,
+                    dst_nodata=np.nan,
+                    resampling=rasterio.warp.Resampling.nearest,
+                )
+    cube.flush()
+    del cube
+    os.replace(tmp_cube_path, cube_path)
+
+    sidecar = {
+        "alg": alg,
+        "subfolder": subfolder,
+        "shape": [len(lake_tifs), number_of_bands, height, width],
+        "dates": list(lake_tifs["date"]),
+        "crs": crs,
+        "transform": list(transform)[:6],
+        "tags": tags_by_time,
+        "sources": sources,
+    }
+    with open(sidecar_path, "w") as f:
+        json.dump(sidecar, f)  # written after the cube, a sidecar always describes a whole cube
+    return subfolder, True
+
+
+def build_cubes(out_folder, cube_root, workers=1):
+    tif_catalog.refresh_tif_catalog(out_folder, workers=workers)
+    tifs_df = tif_catalog.query_tifs(out_folder).dropna(subset=["date"])
+    tifs_df = tifs_df[tifs_df["band_count"] >= number_of_bands]
+
+    cube_dir = os.path.join(cube_root, get_algorithm_name(out_folder))
+    if not os.path.exists(cube_dir):
+        os.makedirs(cube_dir)
+
+    lake_jobs = [
+        (
+            out_folder,
+            subfolder,
+            lake_tifs.sort_values(["date", "path"]).reset_index(drop=True),
+            cube_root,
+        )
+        for subfolder, lake_tifs in tifs_df.groupby("subfolder")
+    ]
+    with multiprocessing.Pool(workers) as pool:
+        for subfolder, rebuilt in tqdm.tqdm(
+            pool.imap_unordered(build_lake_cube, lake_jobs), total=len(lake_jobs)
+        ):
+            if rebuilt:
+                tqdm.tqdm.write(f"{subfolder}: cube rebuilt")
+
+
+def open_cube(cube_root, alg, subfolder):
+    cube_path, sidecar_path = get_cube_paths(cube_root, alg, subfolder)
+    with open(sidecar_path, "r") as f:
+        sidecar = json.load(f)
+    return np.load(cube_path, mmap_mode="r"), sidecar
+
+
+def read_cube(cube_root, alg, subfolder, start_date=None, end_date=None, window=None):
+    # (time, band, y, x) view for scenes within the inclusive YYYY-MM-DD dates, optionally only a
+    # rasterio Window of the lake. Returns the view, its dates and its (window) transform.
+    cube, sidecar = open_cube(cube_root, alg, subfolder)
+    dates = np.array(sidecar["dates"])
+    in_range = np.ones(len(dates), bool)
+    if start_date is not None:
+        in_range &= dates >= str(start_date)[:10]
+    if end_date is not None:
+        in_range &= dates <= str(end_date)[:10]
+    time_indexes = np.flatnonzero(in_range)
+
+    # dates are sorted, so a date range is a contiguous slice and stays memory mapped
+    time_slice = (
+        slice(time_indexes[0], time_indexes[-1] + 1)
+        if len(time_indexes) > 0
+        else slice(0, 0)
+    )
+    transform = Affine(*sidecar["transform"])
+    if window is None:
+        return cube[time_slice], sidecar["dates"][time_slice], transform
+
+    row_slice, col_slice = window.toslices()
+    return (
+        cube[time_slice, :, row_slice, col_slice],
+        sidecar["dates"][time_slice],
+        rasterio.windows.transform(window, transform),
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "out_folders",
+        nargs="+",
+        help="algorithm out folders to pack, e.g. all_flyover_of_lakes_main all_flyover_acolite",
+    )
+    parser.add_argument("--cube-root", default="raster_cubes")
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count())
+    args = parser.parse_args()
+
+    for out_folder in args.out_folders:
+        build_cubes(out_folder, args.cube_root, args.workers)
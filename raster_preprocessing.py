@@ -0,0 +1,70 @@
+import numpy as np
+
+# The one read path for lake tifs: raw bands -> surface reflectance with nan wherever the pixel is
+# unusable. Decoded straight into a float32 buffer (the caller's, if it has one to reuse), then the
+# algorithm's scale/offset and the mask are applied in place. The only other array is one boolean
+# mask buffer, which the caller can also pass in to reuse.
+
+# algorithm tag -> (scale, offset) to surface reflectance, algorithms not listed already are
+scaling_by_algorithm = {
+    "L2": (
+        0.0000275,
+        -0.2,
+    ),  # level 2 data correction https://www.usgs.gov/landsat-missions/landsat-collection-2-surface-reflectance
+}
+
+# surface reflectances above this are clouds (or acolite's 9.96921e+36 out of bounds values)
+cloud_threshold = 0.1
+
+# every reflectance that survives preprocessing, for fixed-bin histograms: L2 bottoms out at its
+# -0.2 offset (water pixels are often slightly negative), the top is the cloud threshold
+reflectance_range = (
+    min(offset for scale, offset in scaling_by_algorithm.values()),
+    cloud_threshold,
+)
+
+
+def get_algorithm(tags, tif_path=""):
+    if "algorithm" in tags:
+        return tags["algorithm"].upper()
+    return "L2" if "L2" in tif_path else "MAIN"  # tifs from before the algorithm tag
+
+
+def preprocess_reflectances(bands, algorithm, mask=None):
+    # in place on a float array, returns it. nan, +-inf and clouds all end up nan. mask is an
+    # optional bool buffer of the same shape, overwritten. Scaling is 2 passes over the bands (L2
+    # only), masking 3 over the bands plus 1 over the bool mask.
+    if algorithm in scaling_by_algorithm:
+        scale, offset = scaling_by_algorithm[algorithm]
+        bands *= scale  # operations on nan/inf are still nan/inf
+        bands += offset
+
+    if mask is None:
+        mask = np.empty(bands.shape, bool)
+    np.greater(bands, -np.inf, out=mask)  # false for nan and -inf
+    np.less_equal(
+        bands, cloud_threshold, out=mask, where=mask
+    )  # clouds and +inf, only where still usable
+    np.logical_not(mask, out=mask)  # now the unusable pixels, inverted in place
+    np.copyto(bands, np.nan, where=mask)
+    return bands
+
+
+def read_reflectances(
+    src, tif_path=None, indexes=None, window=None, out=None, mask=None
+):
+    # src is an open rasterio dataset. out is an optional float32 (bands, rows, cols) buffer to
+    # decode into, e.g. reused across blocks or a slice of a memory mapped cube, mask an optional
+    # bool buffer of the same shape for preprocess_reflectances
+    if tif_path is None:
+        tif_path = src.name
+    if out is None:
+        number_of_bands = src.count if indexes is None else len(indexes)
+        if window is None:
+            height, width = src.height, src.width
+        else:
+            height, width = int(window.height), int(window.width)
+        out = np.empty((number_of_bands, height, width), np.float32)
+
+    src.read(indexes, window=window, out=out)  # gdal converts to float32 while decoding
+    return preprocess_reflectances(out, get_algorithm(src.tags(), tif_path), mask)
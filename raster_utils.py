@@ -2,6 +2,8 @@ import numpy as np
 import rasterio
 from shapely.geometry import Point
 import rasterio.mask
+import rasterio.windows
+import multiprocessing
 
 
 def get_circular_section_from_file(
@@ -22,21 +24,261 @@ def get_circular_section_from_file(
         return out_image
 
 
-def run_analytics_on_raster(raster_array):
-    flatten_raster_array = raster_array.flatten()
-    flatten_raster_array = flatten_raster_array[
-        np.isfinite(flatten_raster_array)
-    ]  # Remove infinities, nans
+def sample_circles_from_file(file_path: str, circles, return_stats=False):
+    # circles is a list of (lat, lng, radius_in_meters). The union of the circles is read once, then
+    # each circle takes the pixels whose centers are within its radius (what rasterio.mask.mask
+    # keeps), from distance grids over just its own bounding box. Returns a (bands, pixels) array of
+    # raw values per circle, or RunningBandStats of the finite values with return_stats=True.
+    with rasterio.open(file_path) as src:
+        x_res = src.res[0]  # same as src.res[1]
+        scale = float(src.tags()["scale"])
+        radii = [
+            x_res * (radius_in_meters / scale) for _, _, radius_in_meters in circles
+        ]  # however many x_res sized pixels needed for buffer of radius at downloaded scale
+
+        union_window = rasterio.windows.from_bounds(
+            min(lng - radius for (_, lng, _), radius in zip(circles, radii)),
+            min(lat - radius for (lat, _, _), radius in zip(circles, radii)),
+            max(lng + radius for (_, lng, _), radius in zip(circles, radii)),
+            max(lat + radius for (lat, _, _), radius in zip(circles, radii)),
+            src.transform,
+        )
+        col_off = int(np.floor(union_window.col_off))
+        row_off = int(np.floor(union_window.row_off))
+        try:
+            union_window = rasterio.windows.Window(
+                col_off,
+                row_off,
+                int(np.ceil(union_window.col_off + union_window.width)) - col_off,
+                int(np.ceil(union_window.row_off + union_window.height)) - row_off,
+            ).intersection(rasterio.windows.Window(0, 0, src.width, src.height))
+            bands = src.read(window=union_window)
+            window_transform = src.window_transform(union_window)
+        except rasterio.errors.WindowError as e:  # no circle overlaps this raster
+            bands = np.zeros((src.count, 0, 0), src.dtypes[0])
+            window_transform = src.transform
+
+    # pixel center coordinates of the union window
+    x_centers = window_transform.c + (np.arange(bands.shape[2]) + 0.5) * window_transform.a
+    y_centers = window_transform.f + (np.arange(bands.shape[1]) + 0.5) * window_transform.e
+
+    results = []
+    for (lat, lng, _), radius in zip(circles, radii):
+        dx_squared = np.square(x_centers - lng)
+        dy_squared = np.square(y_centers - lat)
+        cols = np.flatnonzero(dx_squared <= radius**2)
+        rows = np.flatnonzero(dy_squared <= radius**2)
+
+        if len(cols) == 0 or len(rows) == 0:
+            pixels = np.zeros((bands.shape[0], 0), bands.dtype)
+        else:
+            col_slice = slice(cols[0], cols[-1] + 1)
+            row_slice = slice(rows[0], rows[-1] + 1)
+            inside_circle = (
+                dy_squared[row_slice, None] + dx_squared[None, col_slice] <= radius**2
+            )
+            pixels = bands[:, row_slice, col_slice][:, inside_circle]
+
+        if return_stats:
+            circle_stats = RunningBandStats(len(pixels))
+            for band_index in range(len(pixels)):
+                band_pixels = pixels[band_index]
+                circle_stats.update_band(band_index, band_pixels[np.isfinite(band_pixels)])
+            results.append(circle_stats)
+        else:
+            results.append(pixels)
+    return results
+
 
-    max_val = np.nanmax(flatten_raster_array)
-    min_val = np.nanmin(flatten_raster_array)
+def sample_file_group(args):
+    file_path, circles, return_stats = args
+    return sample_circles_from_file(file_path, circles, return_stats)
 
-    mean_val = np.nanmean(flatten_raster_array)  # mean EXCLUDING nans
-    stdev = np.nanstd(flatten_raster_array)  # std EXCLUDING nans
 
-    # top_ten_highest_indices = np.argpartition(flatten_raster_array, -10)[-10:]
-    # top_ten = flatten_raster_array[top_ten_highest_indices]
-    # top_ten.sort()
-    # print("Top ten: ", top_ten)
+def sample_circles(requests, return_stats=False, workers=1):
+    # requests is a list of (file_path, lat, lng, radius_in_meters), in any order. Requests for the
+    # same file are grouped so each file is opened and read once, results come back in request order.
+    circles_by_file = {}
+    request_indexes_by_file = {}
+    for request_index, (file_path, lat, lng, radius_in_meters) in enumerate(requests):
+        circles_by_file.setdefault(file_path, []).append((lat, lng, radius_in_meters))
+        request_indexes_by_file.setdefault(file_path, []).append(request_index)
+
+    file_jobs = [
+        (file_path, circles, return_stats)
+        for file_path, circles in circles_by_file.items()
+    ]
+    if workers > 1:
+        with multiprocessing.Pool(workers) as pool:
+            file_results = pool.map(sample_file_group, file_jobs)
+    else:
+        file_results = list(map(sample_file_group, file_jobs))
+
+    results = [None] * len(requests)
+    for (file_path, _, _), circle_results in zip(file_jobs, file_results):
+        for request_index, circle_result in zip(
+            request_indexes_by_file[file_path], circle_results
+        ):
+            results[request_index] = circle_result
+    return results
+
+
+def run_analytics_on_raster(raster_array):
+    # nans and infinities are skipped, all nan gives nans instead of raising
+    raster_stats = RunningBandStats(1)
+    raster_stats.update_from_stack(raster_array.reshape(1, -1))
+
+    max_val = raster_stats.max[0] if raster_stats.count[0] > 0 else np.nan
+    min_val = raster_stats.min[0] if raster_stats.count[0] > 0 else np.nan
+    mean_val = raster_stats.means()[0]  # mean EXCLUDING nans
+    stdev = raster_stats.stds()[0]  # std EXCLUDING nans
 
     return max_val, min_val, mean_val, stdev
+
+
+def get_raster_stats(args):
+    file_path, quantile_bins, quantile_range = args
+    with rasterio.open(file_path) as src:
+        raster_stats = RunningBandStats(
+            src.count, quantile_bins=quantile_bins, quantile_range=quantile_range
+        )
+        raster_stats.update_from_stack(src.read())
+    return raster_stats
+
+
+def get_stats_for_rasters(
+    file_paths, quantile_bins=None, quantile_range=(0.0, 0.1), workers=1
+):
+    # one RunningBandStats per file, functools.reduce(RunningBandStats.merge, ...) for the total.
+    # Values are the raw src.read() ones, so quantile_range has to fit them, e.g. the L2 digital
+    # numbers (0, 65535) or a DOC map's mg/L, not the reflectance default
+    jobs = [(file_path, quantile_bins, quantile_range) for file_path in file_paths]
+    if workers > 1:
+        with multiprocessing.Pool(workers) as pool:
+            return pool.map(get_raster_stats, jobs, chunksize=8)
+    return list(map(get_raster_stats, jobs))
+
+
+class RunningBandStats:
+    # Per band count, mean, variance, min, max (and optionally a fixed-bin histogram to read
+    # quantiles from) that can be fed pixel arrays one file at a time and merged across files
+    # or workers, so long date ranges don't have to keep every pixel around.
+    chunk_pixels = 1 << 14  # per band, a 5 band float64 chunk is 640 KB
+
+    def __init__(self, number_of_bands, quantile_bins=None, quantile_range=(0.0, 0.1)):
+        self.count = np.zeros(number_of_bands, np.int64)
+        self.mean = np.zeros(number_of_bands, np.float64)
+        self.m2 = np.zeros(number_of_bands, np.float64)  # sum of squared differences from the mean
+        self.min = np.full(number_of_bands, np.inf)
+        self.max = np.full(number_of_bands, -np.inf)
+
+        self.histogram = None
+        if quantile_bins is not None:
+            self.bin_edges = np.linspace(
+                quantile_range[0], quantile_range[1], quantile_bins + 1
+            )
+            self.histogram = np.zeros((number_of_bands, quantile_bins), np.int64)
+
+    def _combine(self, band_index, count, mean, m2, min_val, max_val):
+        # Chan et al. parallel variance update
+        total_count = self.count[band_index] + count
+        delta = mean - self.mean[band_index]
+        self.mean[band_index] += delta * count / total_count
+        self.m2[band_index] += m2 + delta**2 * self.count[band_index] * count / total_count
+        self.count[band_index] = total_count
+        self.min[band_index] = min(self.min[band_index], min_val)
+        self.max[band_index] = max(self.max[band_index], max_val)
+
+    def update_band(self, band_index, values):
+        # values is a 1d array of valid (finite) pixels for this band
+        if values.size == 0:
+            return
+        batch_mean = values.mean(dtype=np.float64)
+        batch_m2 = np.square(values - batch_mean, dtype=np.float64).sum()
+        self._combine(
+            band_index, values.size, batch_mean, batch_m2, values.min(), values.max()
+        )
+
+        if self.histogram is not None:
+            self.histogram[band_index] += np.histogram(
+                np.clip(values, self.bin_edges[0], self.bin_edges[-1]),
+                bins=self.bin_edges,
+            )[0]
+
+    def update_from_stack(self, stack):
+        # stack is (bands, ...), e.g. a tif's src.read(). Walked in chunks of chunk_pixels pixels per
+        # band: each chunk gets its ufunc reductions (with where= skipping the nan/inf pixels) and
+        # is merged with _combine, so the finite mask and deviation buffer stay chunk sized and in
+        # cache instead of full size float64 copies of the stack. That is about 8 passes per chunk.
+        stack = stack.reshape(len(self.count), -1)
+        deviations = np.empty((len(self.count), min(self.chunk_pixels, stack.shape[1])))
+        for start in range(0, stack.shape[1], self.chunk_pixels):
+            chunk = stack[:, start : start + self.chunk_pixels]
+            if not np.issubdtype(chunk.dtype, np.floating):
+                chunk = chunk.astype(np.float64)
+            finite = np.isfinite(chunk)
+
+            count = np.count_nonzero(finite, axis=1)
+            total = np.sum(chunk, axis=1, where=finite, dtype=np.float64)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                mean = total / count
+            chunk_deviations = deviations[:, : chunk.shape[1]]
+            chunk_deviations.fill(0)
+            np.subtract(chunk, mean[:, None], out=chunk_deviations, where=finite)
+            m2 = np.einsum("ij,ij->i", chunk_deviations, chunk_deviations)
+            min_val = np.min(chunk, axis=1, where=finite, initial=np.inf)
+            max_val = np.max(chunk, axis=1, where=finite, initial=-np.inf)
+
+            for band_index in np.flatnonzero(count):
+                self._combine(
+                    band_index,
+                    count[band_index],
+                    mean[band_index],
+                    m2[band_index],
+                    min_val[band_index],
+                    max_val[band_index],
+                )
+                if self.histogram is not None:
+                    self.histogram[band_index] += np.histogram(
+                        np.clip(
+                            chunk[band_index][finite[band_index]],
+                            self.bin_edges[0],
+                            self.bin_edges[-1],
+                        ),
+                        bins=self.bin_edges,
+                    )[0]
+
+    def merge(self, other):
+        for band_index in range(len(self.count)):
+            if other.count[band_index] == 0:
+                continue
+            self._combine(
+                band_index,
+                other.count[band_index],
+                other.mean[band_index],
+                other.m2[band_index],
+                other.min[band_index],
+                other.max[band_index],
+            )
+        if self.histogram is not None:
+            self.histogram += other.histogram
+        return self
+
+    def means(self):
+        return np.where(self.count > 0, self.mean, np.nan)
+
+    def stds(self):  # population std, same as np.nanstd
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(self.count > 0, np.sqrt(self.m2 / self.count), np.nan)
+
+    def quantiles(self, quantiles):
+        # approximate, interpolated within the histogram bins. shape (bands, len(quantiles))
+        band_quantiles = np.full((len(self.count), len(quantiles)), np.nan)
+        for band_index in range(len(self.count)):
+            if self.count[band_index] == 0:
+                continue
+            cumulative = np.concatenate(([0], np.cumsum(self.histogram[band_index])))
+            band_quantiles[band_index] = np.interp(
+                np.asarray(quantiles) * cumulative[-1], cumulative, self.bin_edges
+            )
+        return band_quantiles
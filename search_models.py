@@ -0,0 +1,240 @@
+import os
+import json
+import time
+import argparse
+import itertools
+import multiprocessing
+import numpy as np
+from sklearn.ensemble import RandomForestRegressor
+from sklearn.model_selection import GroupKFold
+from sklearn.metrics import r2_score, root_mean_squared_error
+import train_models
+
+# Successive halving over random forest hyperparameters, with n_estimators as the budget: every
+# candidate gets a cheap forest, only the best 1/eta move on to eta times more trees. Scored by
+# grouped-by-lake CV rmse (ln doc). The features are saved once as .npy and memory mapped read only
+# by every worker, and each evaluation is appended to trace.jsonl so a killed search picks up where
+# it stopped.
+
+default_search_space = {
+    "max_depth": [None, 4, 8, 16],
+    "min_samples_leaf": [1, 2, 4, 8],
+    "max_features": [0.4, 0.6, 0.8, 1.0],
+}
+
+# set per worker by load_shared_features
+X = None
+y = None
+groups = None
+splits = None
+
+
+def load_shared_features(search_dir):
+    global X, y, groups, splits
+    X = np.load(os.path.join(search_dir, "X.npy"), mmap_mode="r")
+    y = np.load(os.path.join(search_dir, "y.npy"), mmap_mode="r")
+    groups = np.load(os.path.join(search_dir, "groups.npy"), mmap_mode="r")
+    with open(os.path.join(search_dir, "splits.json"), "r") as f:
+        splits = [
+            (np.array(train_index), np.array(test_index))
+            for train_index, test_index in json.load(f)
+        ]
+
+
+def evaluate_candidate(args):
+    candidate_id, params, n_estimators, rung, random_state = args
+    start_time = time.time()
+
+    predictions = np.full(len(y), np.nan)
+    for train_index, test_index in splits:
+        model = RandomForestRegressor(
+            n_estimators=n_estimators, random_state=random_state, n_jobs=1, **params
+        )
+        model.fit(X[train_index], y[train_index])
+        predictions[test_index] = model.predict(X[test_index])
+
+    return {
+        "candidate_id": candidate_id,
+        "rung": rung,
+        "n_estimators": n_estimators,
+        "params": params,
+        "rmse": float(root_mean_squared_error(y, predictions)),
+        "r2": float(r2_score(y, predictions)),
+        "seconds": time.time() - start_time,
+    }
+
+
+def get_candidates(search_space, number_of_candidates, random_state):
+    # every combination if it fits, otherwise a seeded sample of them
+    keys = sorted(search_space)
+    combinations = [
+        dict(zip(keys, values))
+        for values in itertools.product(*(search_space[key] for key in keys))
+    ]
+    if number_of_candidates < len(combinations):
+        rng = np.random.default_rng(random_state)
+        chosen = rng.choice(len(combinations), number_of_candidates, replace=False)
+        combinations = [combinations[i] for i in sorted(chosen)]
+    return combinations
+
+
+def prepare_search_dir(alg_df, alg, search_space, args):
+    X, y, groups = train_models.get_features_and_target(alg_df)
+    n_splits = min(args.n_splits, len(np.unique(groups)))
+    if n_splits < 2:
+        raise Exception(f"{alg} needs at least 2 lakes for grouped cross validation.")
+
+    search_settings = {
+        "search_space": search_space,
+        "number_of_candidates": args.candidates,
+        "min_estimators": args.min_estimators,
+        "max_estimators": args.max_estimators,
+        "eta": args.eta,
+        "n_splits": n_splits,
+        "random_state": args.random_state,
+    }
+    search_key = train_models.get_cache_key(X, y, groups, search_settings, n_splits)
+    search_dir = os.path.join(args.search_dir, f"{alg}_{search_key}")
+
+    if not os.path.exists(os.path.join(search_dir, "search.json")):
+        if not os.path.exists(search_dir):
+            os.makedirs(search_dir)
+        np.save(os.path.join(search_dir, "X.npy"), X)
+        np.save(os.path.join(search_dir, "y.npy"), y)
+        np.save(os.path.join(search_dir, "groups.npy"), groups)
+        with open(os.path.join(search_dir, "splits.json"), "w") as f:
+            json.dump(
+                [
+                    (train_index.tolist(), test_index.tolist())
+                    for train_index, test_index in GroupKFold(n_splits).split(
+                        X, y, groups
+                    )
+                ],
+                f,
+            )
+        search_settings["candidates"] = get_candidates(
+            search_space, args.candidates, args.random_state
+        )
+        with open(os.path.join(search_dir, "search.json"), "w") as f:
+            json.dump(search_settings, f, indent=2)  # written last, the dir is usable
+
+    return search_dir
+
+
+def load_trace(trace_path):
+    trace = {}
+    if os.path.exists(trace_path):
+        with open(trace_path, "r") as f:
+            trace_text = f.read()
+        for line in trace_text.splitlines():
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # the last line of a killed run can be cut off
+            trace[(record["candidate_id"], record["rung"])] = record
+        if trace_text != "" and not trace_text.endswith("\n"):
+            with open(trace_path, "a") as f:
+                f.write("\n")  # so the next record doesn't get glued onto the cut off one
+    return trace
+
+
+def run_successive_halving(search_dir, workers):
+    with open(os.path.join(search_dir, "search.json"), "r") as f:
+        search_settings = json.load(f)
+    candidates = search_settings["candidates"]
+    eta = search_settings["eta"]
+
+    trace_path = os.path.join(search_dir, "trace.jsonl")
+    trace = load_trace(trace_path)
+    if len(trace) > 0:
+        print(f"Resuming {search_dir}, {len(trace)} evaluations already in the trace")
+
+    surviving_ids = list(range(len(candidates)))
+    n_estimators = search_settings["min_estimators"]
+    rung = 0
+    with multiprocessing.Pool(
+        workers, initializer=load_shared_features, initargs=(search_dir,)
+    ) as pool:
+        while True:
+            to_evaluate = [
+                (
+                    candidate_id,
+                    candidates[candidate_id],
+                    n_estimators,
+                    rung,
+                    search_settings["random_state"],
+                )
+                for candidate_id in surviving_ids
+                if (candidate_id, rung) not in trace
+            ]
+            with open(trace_path, "a") as trace_file:
+                for record in pool.imap_unordered(evaluate_candidate, to_evaluate):
+                    trace[(record["candidate_id"], rung)] = record
+                    trace_file.write(json.dumps(record) + "\n")
+                    trace_file.flush()
+
+            rung_records = sorted(
+                (trace[(candidate_id, rung)] for candidate_id in surviving_ids),
+                key=lambda record: record["rmse"],
+            )
+            print(
+                f"rung {rung}: {len(rung_records)} candidates at {n_estimators} trees, best rmse {rung_records[0]['rmse']:.4f}"
+            )
+
+            if (
+                len(surviving_ids) == 1
+                or n_estimators >= search_settings["max_estimators"]
+            ):
+                break
+
+            number_to_keep = max(1, len(surviving_ids) // eta)
+            surviving_ids = [
+                record["candidate_id"] for record in rung_records[:number_to_keep]
+            ]
+            n_estimators = min(n_estimators * eta, search_settings["max_estimators"])
+            rung += 1
+
+    best_record = rung_records[0]
+    with open(os.path.join(search_dir, "best.json"), "w") as f:
+        json.dump(best_record, f, indent=2)
+    return best_record
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "training_data",
+        help="training_data.csv, or the parquet dataset dir from assemble_training_df.py --parquet",
+    )
+    parser.add_argument("--algs", nargs="+", default=None, help="e.g. MAIN L2 ACOLITE")
+    parser.add_argument(
+        "--search-space",
+        default=None,
+        help='json file of {"param": [values, ...]}, defaults to max_depth/min_samples_leaf/max_features',
+    )
+    parser.add_argument("--candidates", type=int, default=32)
+    parser.add_argument("--min-estimators", type=int, default=25)
+    parser.add_argument("--max-estimators", type=int, default=800)
+    parser.add_argument("--eta", type=int, default=3)
+    parser.add_argument("--n-splits", type=int, default=5)
+    parser.add_argument("--random-state", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--search-dir", default="model_search")
+    args = parser.parse_args()
+
+    search_space = default_search_space
+    if args.search_space is not None:
+        with open(args.search_space, "r") as f:
+            search_space = json.load(f)
+
+    training_df = train_models.load_training_data(args.training_data, args.algs)
+    algs = args.algs if args.algs else sorted(training_df["alg"].unique())
+
+    for alg in algs:
+        search_dir = prepare_search_dir(
+            training_df[training_df["alg"] == alg], alg, search_space, args
+        )
+        best_record = run_successive_halving(search_dir, args.workers)
+        print(
+            f"{alg}: best {best_record['params']} with {best_record['n_estimators']} trees, rmse {best_record['rmse']:.4f}, r2 {best_record['r2']:.3f}"
+        )
@@ -0,0 +1,150 @@
+import matplotlib
+
+matplotlib.use("Agg")  # plots are rendered offscreen, in worker processes
+
+import os
+import argparse
+import multiprocessing
+import pandas as pd
+from matplotlib import pyplot as plt
+from matplotlib.lines import Line2D
+import raster_preprocessing
+import raster_utils
+import reflectance_plots
+import tif_catalog
+
+# Centroid spectra for every (lake, algorithm, year-month) from one scan of each archive folder,
+# instead of rescanning all three archives for every month we want to plot.
+
+band_names = ["443", "483", "561", "655", "865"]
+algorithm_colors = {"L2": "green", "MAIN": "blue", "ACOLITE": "red"}
+quantiles = [0.1, 0.5, 0.9]
+
+
+def get_algorithm_name(out_folder):
+    return (
+        os.path.normpath(out_folder).split("_")[-1].upper()
+    )  # our convention is last underscore contains alg name
+
+
+def scan_lake_folder(args):
+    out_folder, subfolder, lake_tifs_df = args
+    algorithm_name = get_algorithm_name(out_folder)
+
+    band_stats_by_period = {}
+    for tif_filepath, date in zip(lake_tifs_df["path"], lake_tifs_df["date"]):
+        year_month = date[:7]
+        if year_month not in band_stats_by_period:
+            band_stats_by_period[year_month] = raster_utils.RunningBandStats(
+                len(band_names),
+                quantile_bins=1000,
+                quantile_range=raster_preprocessing.reflectance_range,
+            )
+        reflectance_plots.add_centroid_pixels_to_stats(
+            tif_filepath, band_stats_by_period[year_month]
+        )
+
+    objectid = lake_tifs_df["objectid"].iloc[0]
+    rows = []
+    for year_month, band_stats in band_stats_by_period.items():
+        means = band_stats.means()
+        stds = band_stats.stds()
+        band_quantiles = band_stats.quantiles(quantiles)
+        for band_index in range(len(band_names)):
+            row = {
+                "lake": subfolder,
+                "objectid": objectid,
+                "algorithm": algorithm_name,
+                "year_month": year_month,
+                "band": band_names[band_index],
+                "pixel_count": band_stats.count[band_index],
+                "mean": means[band_index],
+                "std": stds[band_index],
+                "min": band_stats.min[band_index],
+                "max": band_stats.max[band_index],
+            }
+            for quantile_index in range(len(quantiles)):
+                row[f"p{int(quantiles[quantile_index] * 100)}"] = band_quantiles[
+                    band_index, quantile_index
+                ]
+            rows.append(row)
+    return rows
+
+
+def build_spectral_table(out_folders, workers):
+    scan_jobs = []
+    for out_folder in out_folders:
+        tif_catalog.refresh_tif_catalog(out_folder, workers=workers)
+        tifs_df = tif_catalog.query_tifs(out_folder)
+        tifs_df = tifs_df.dropna(subset=["date"])
+        for subfolder, lake_tifs_df in tifs_df.groupby("subfolder"):
+            scan_jobs.append((out_folder, subfolder, lake_tifs_df))
+
+    with multiprocessing.Pool(workers) as pool:
+        all_rows = []
+        for rows in pool.imap_unordered(scan_lake_folder, scan_jobs):
+            all_rows.extend(rows)
+
+    spectral_df = pd.DataFrame(all_rows)
+    return spectral_df.sort_values(["year_month", "lake", "algorithm"]).reset_index(
+        drop=True
+    )
+
+
+def render_period(args):
+    year_month, period_df, plots_dir = args
+    fig, ax = plt.subplots()
+
+    for (lake, algorithm_name), lake_df in period_df.groupby(["lake", "algorithm"]):
+        lake_df = lake_df.set_index("band").loc[band_names]
+        if (lake_df["pixel_count"] == 0).any():
+            continue  # a band without pixels would give a blank graph, don't use this lake
+        ax.plot(
+            [f"B{i+1}" for i in range(len(band_names))],
+            lake_df["mean"],
+            color=algorithm_colors.get(algorithm_name, "black"),
+        )
+
+    ax.set_xlabel("Band")
+    ax.set_ylabel("Mean Reflectance")
+    ax.set_title(f"{year_month} Mean Reflectances")
+    ax.legend(
+        handles=[
+            Line2D([0], [0], color=color, lw=4, label=algorithm_name)
+            for algorithm_name, color in algorithm_colors.items()
+        ]
+    )
+
+    plot_path = os.path.join(plots_dir, f"spectra_{year_month}.png")
+    fig.savefig(plot_path)
+    plt.close(fig)
+    return plot_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "out_folders",
+        nargs="+",
+        help="archive folders, e.g. all_flyover_of_lakes_main all_flyover_of_lakes_L2 all_flyover_acolite",
+    )
+    parser.add_argument("--out-dir", default="spectral_atlas")
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count())
+    args = parser.parse_args()
+
+    plots_dir = os.path.join(args.out_dir, "plots")
+    if not os.path.exists(plots_dir):
+        os.makedirs(plots_dir)
+
+    spectral_df = build_spectral_table(args.out_folders, args.workers)
+    table_path = os.path.join(args.out_dir, "spectral_atlas.csv")
+    spectral_df.to_csv(table_path, index=False)
+    print(f"Wrote {len(spectral_df)} rows to {table_path}")
+
+    render_jobs = [
+        (year_month, period_df, plots_dir)
+        for year_month, period_df in spectral_df.groupby("year_month")
+    ]
+    with multiprocessing.Pool(args.workers) as pool:
+        for plot_path in pool.imap_unordered(render_period, render_jobs):
+            print("Rendered:", plot_path)
@@ -0,0 +1,97 @@
+import contextlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+
+# Timing spans around each stage of a fetch. Every worker process appends its spans to its own
+# jsonl file (so failed and retried jobs are counted too), and the driver aggregates them into
+# per-stage histograms once the pool is done.
+
+STAGE_TIMING_DIR_ENV = "STAGE_TIMING_DIR"
+
+
+def enable():
+    # call in the driver before the pool starts so the workers inherit it. The spans live
+    # outside of the out dir, since every folder in there is treated as a lake folder.
+    spans_dir = tempfile.mkdtemp(prefix="stage_timings_")
+    os.environ[STAGE_TIMING_DIR_ENV] = spans_dir
+    return spans_dir
+
+
+@contextlib.contextmanager
+def timed_stage(stage_name):
+    # yields the span so the stage can fill in span["bytes"]
+    span = {"stage": stage_name, "bytes": 0, "ok": False}
+    start_time = time.perf_counter()
+    try:
+        yield span
+        span["ok"] = True
+    finally:
+        span["seconds"] = time.perf_counter() - start_time
+        spans_dir = os.environ.get(STAGE_TIMING_DIR_ENV)
+        if spans_dir:
+            with open(os.path.join(spans_dir, f"{os.getpid()}.jsonl"), "a") as f:
+                f.write(json.dumps(span) + "\n")
+
+
+def summarize(spans_dir):
+    spans = []
+    for filename in os.listdir(spans_dir):
+        with open(os.path.join(spans_dir, filename)) as f:
+            spans.extend(json.loads(line) for line in f if line.strip())
+
+    summary = {}
+    if len(spans) == 0:
+        return summary
+
+    spans_df = pd.DataFrame(spans)
+    for stage_name, stage_df in spans_df.groupby("stage", sort=False):
+        seconds = stage_df["seconds"].to_numpy()
+        p50, p95, p99 = np.percentile(seconds, [50, 95, 99])
+        summary[stage_name] = {
+            "count": int(len(seconds)),
+            "failed": int((~stage_df["ok"]).sum()),
+            "total_seconds": float(seconds.sum()),
+            "p50_seconds": float(p50),
+            "p95_seconds": float(p95),
+            "p99_seconds": float(p99),
+            "max_seconds": float(seconds.max()),
+            "bytes": int(stage_df["bytes"].sum()),
+        }
+    return summary
+
+
+def print_summary(summary):
+    all_stages_seconds = sum(stage["total_seconds"] for stage in summary.values())
+    print(
+        f"{'stage':<28}{'count':>8}{'failed':>8}{'p50 s':>9}{'p95 s':>9}{'p99 s':>9}{'share':>8}{'MB':>10}"
+    )
+    for stage_name, stage in summary.items():
+        share = stage["total_seconds"] / all_stages_seconds if all_stages_seconds else 0
+        print(
+            f"{stage_name:<28}{stage['count']:>8}{stage['failed']:>8}"
+            f"{stage['p50_seconds']:>9.2f}{stage['p95_seconds']:>9.2f}{stage['p99_seconds']:>9.2f}"
+            f"{share:>8.1%}{stage['bytes'] / 1e6:>10.1f}"
+        )
+
+
+def write_summary(spans_dir, json_path):
+    summary = summarize(spans_dir)
+    with open(json_path, "w") as f:
+        json.dump(summary, f, indent=4)
+    print_summary(summary)
+    shutil.rmtree(spans_dir)
+    return summary
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("python stage_timing.py <spans_dir>")
+        sys.exit(1)
+
+    print_summary(summarize(sys.argv[1]))
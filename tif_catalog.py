@@ -0,0 +1,173 @@
+import os
+import sqlite3
+import sys
+import multiprocessing
+import numpy as np
+import pandas as pd
+import rasterio
+
+# Per archive folder catalog of every tif's tags, shape and valid pixel fraction. Tifs are only
+# opened when they are new or changed (by mtime and size), so refreshing an existing catalog is
+# a directory walk, and plot/analysis scripts can select tifs by real scene dates.
+
+TIF_CATALOG_FILENAME = "tif_catalog.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tifs (
+    path TEXT PRIMARY KEY, -- relative to the archive folder
+    subfolder TEXT NOT NULL,
+    objectid INTEGER,
+    date TEXT, -- satellite scene date
+    closest_insitu_date TEXT,
+    algorithm TEXT,
+    scale INTEGER,
+    image_index TEXT,
+    band_count INTEGER,
+    height INTEGER,
+    width INTEGER,
+    valid_fraction REAL, -- pixels that are finite in every band
+    mtime REAL NOT NULL,
+    size_bytes INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tifs_by_lake_date ON tifs (objectid, date);
+CREATE INDEX IF NOT EXISTS tifs_by_subfolder_date ON tifs (subfolder, date);
+CREATE INDEX IF NOT EXISTS tifs_by_date ON tifs (date);
+"""
+
+
+def open_tif_catalog(out_folder):
+    connection = sqlite3.connect(os.path.join(out_folder, TIF_CATALOG_FILENAME), timeout=60)
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def read_tif_entry(args):
+    out_folder, relative_path, mtime, size_bytes = args
+    tif_filepath = os.path.join(out_folder, relative_path)
+    try:
+        with rasterio.open(tif_filepath) as src:
+            tags = src.tags()
+            bands = src.read()
+            nodata = src.nodata
+            band_count, height, width = src.count, src.height, src.width
+    except rasterio.errors.RasterioIOError as e:
+        return None  # not a tif (or a broken download), leave it out of the catalog
+
+    valid_pixels = np.isfinite(bands)
+    if nodata is not None and np.isfinite(nodata):
+        valid_pixels &= bands != nodata
+    valid_fraction = float(valid_pixels.all(axis=0).mean()) if bands.size else 0.0
+
+    return (
+        relative_path,
+        os.path.dirname(relative_path),
+        int(float(tags["objectid"])) if "objectid" in tags else None,
+        tags.get("date"),
+        tags.get("closest_insitu_date"),
+        tags.get("algorithm"),
+        int(float(tags["scale"])) if "scale" in tags else None,
+        tags.get("image_index"),
+        band_count,
+        height,
+        width,
+        valid_fraction,
+        mtime,
+        size_bytes,
+    )
+
+
+def refresh_tif_catalog(out_folder, workers=1):
+    connection = open_tif_catalog(out_folder)
+    cataloged = {
+        path: (mtime, size_bytes)
+        for path, mtime, size_bytes in connection.execute(
+            "SELECT path, mtime, size_bytes FROM tifs"
+        )
+    }
+
+    on_disk = set()
+    to_read = []
+    subfolders = list(os.listdir(out_folder))
+    subfolders.sort()
+    for subfolder in subfolders:
+        if os.path.isfile(os.path.join(out_folder, subfolder)):
+            continue  # this is the log file (or this catalog)
+        for filename in os.listdir(os.path.join(out_folder, subfolder)):
+            relative_path = os.path.join(subfolder, filename)
+            stat = os.stat(os.path.join(out_folder, relative_path))
+            on_disk.add(relative_path)
+            if cataloged.get(relative_path) != (stat.st_mtime, stat.st_size):
+                to_read.append((out_folder, relative_path, stat.st_mtime, stat.st_size))
+
+    if workers > 1 and len(to_read) > 0:
+        with multiprocessing.Pool(workers) as pool:
+            entries = pool.map(read_tif_entry, to_read, chunksize=16)
+    else:
+        entries = list(map(read_tif_entry, to_read))
+    entries = [entry for entry in entries if entry is not None]
+
+    removed = [(path,) for path in cataloged if path not in on_disk]
+    with connection:
+        connection.executemany(
+            "INSERT OR REPLACE INTO tifs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            entries,
+        )
+        connection.executemany("DELETE FROM tifs WHERE path = ?", removed)
+    connection.close()
+
+    print(
+        f"{out_folder}: {len(entries)} tifs (re)cataloged, {len(removed)} removed, {len(on_disk) - len(to_read)} unchanged"
+    )
+
+
+def query_tifs(
+    out_folder,
+    objectid=None,
+    subfolder=None,
+    start_date=None,
+    end_date=None,
+    algorithm=None,
+    min_valid_fraction=None,
+) -> pd.DataFrame:
+    # start_date and end_date are inclusive YYYY-MM-DD scene dates
+    conditions = []
+    params = []
+    if objectid is not None:
+        conditions.append("objectid = ?")
+        params.append(int(float(objectid)))
+    if subfolder is not None:
+        conditions.append("subfolder = ?")
+        params.append(subfolder)
+    if start_date is not None:
+        conditions.append("date >= ?")
+        params.append(str(start_date)[:10])
+    if end_date is not None:
+        conditions.append("date <= ?")
+        params.append(str(end_date)[:10])
+    if algorithm is not None:
+        conditions.append("algorithm = ?")
+        params.append(algorithm)
+    if min_valid_fraction is not None:
+        conditions.append("valid_fraction >= ?")
+        params.append(min_valid_fraction)
+
+    query = "SELECT * FROM tifs"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += " ORDER BY subfolder, date"
+
+    connection = open_tif_catalog(out_folder)
+    tifs_df = pd.read_sql_query(query, connection, params=params)
+    connection.close()
+
+    tifs_df["path"] = tifs_df["path"].map(lambda path: os.path.join(out_folder, path))
+    return tifs_df
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("python tif_catalog.py <out_folder> [<out_folder> ...]")
+        sys.exit(1)
+
+    for out_folder in sys.argv[1:]:
+        refresh_tif_catalog(out_folder, workers=multiprocessing.cpu_count())
@@ -0,0 +1,253 @@
+import os
+import json
+import hashlib
+import shutil
+import argparse
+import multiprocessing
+import joblib
+import numpy as np
+import pandas as pd
+from sklearn.ensemble import RandomForestRegressor
+from sklearn.model_selection import GroupKFold
+from sklearn.metrics import r2_score, root_mean_squared_error, mean_absolute_error
+import lake_geometry
+
+# Random forest DOC models on the band means from assemble_training_df.py, one model per algorithm.
+# Evaluated with folds grouped by lake (a lake is never in both train and test), and everything is
+# cached under model_cache/ keyed by the data hash + hyperparameters so an unchanged run is a read.
+
+band_names = ["443", "483", "561", "655", "865"]
+
+default_hyperparameters = {
+    "n_estimators": 500,
+    "max_depth": None,
+    "min_samples_leaf": 1,
+    "max_features": 1.0,
+    "random_state": 0,
+}
+
+
+def load_training_data(training_data_path, algs=None) -> pd.DataFrame:
+    if os.path.isdir(training_data_path):
+        # parquet dataset from assemble_training_df.py --parquet, only read the partitions needed
+        filters = [("alg", "in", algs)] if algs else None
+        training_df = pd.read_parquet(training_data_path, filters=filters)
+        training_df["alg"] = training_df["alg"].astype(str)
+        training_df["lakeid"] = training_df["lakeid"].astype(int)
+    else:
+        training_df = pd.read_csv(training_data_path)
+        if algs:
+            training_df = training_df[training_df["alg"].isin(algs)]
+    return training_df
+
+
+def get_features_and_target(alg_df):
+    alg_df = alg_df.dropna(subset=band_names + ["doc"])
+    alg_df = alg_df[alg_df["doc"] > 0]
+    alg_df = alg_df.sort_values(["lakeid", "date"] if "date" in alg_df else ["lakeid"])
+    X = alg_df[band_names].to_numpy(dtype=np.float64)
+    y = np.log(alg_df["doc"].to_numpy(dtype=np.float64))  # base e, like apply_equations
+    groups = alg_df["lakeid"].to_numpy(dtype=np.int64)
+    return X, y, groups
+
+
+def get_cache_key(X, y, groups, hyperparameters, n_splits):
+    digest = hashlib.sha256()
+    for array in [X, y, groups]:
+        digest.update(np.ascontiguousarray(array).tobytes())
+    digest.update(
+        json.dumps(
+            {"hyperparameters": hyperparameters, "n_splits": n_splits}, sort_keys=True
+        ).encode()
+    )
+    return digest.hexdigest()[:16]
+
+
+def get_fold_splits(X, y, groups, n_splits, cache_dir):
+    splits_path = os.path.join(cache_dir, "splits.joblib")
+    if os.path.exists(splits_path):
+        return joblib.load(splits_path)
+    splits = list(GroupKFold(n_splits=n_splits).split(X, y, groups))
+    joblib.dump(splits, splits_path)
+    return splits
+
+
+def fit_fold(X, y, train_index, test_index, hyperparameters, model_n_jobs, fold_path):
+    if os.path.exists(fold_path):
+        return joblib.load(fold_path)["predictions"]
+
+    model = RandomForestRegressor(n_jobs=model_n_jobs, **hyperparameters)
+    model.fit(X[train_index], y[train_index])
+    predictions = model.predict(X[test_index])
+
+    joblib.dump(
+        {"model": model, "test_index": test_index, "predictions": predictions},
+        fold_path,
+        compress=3,
+    )
+    return predictions
+
+
+def get_results_df(y, predictions, groups, model_name):
+    # same shape as apply_equations.py results.csv, one row per lake
+    list_of_results_df_rows = []
+    for lakeid in np.unique(groups):
+        in_lake = groups == lakeid
+        y_lake = y[in_lake]
+        predicted_lake = predictions[in_lake]
+
+        results_df_row = {}
+        results_df_row[f"{model_name}_r2"] = (
+            r2_score(y_lake, predicted_lake) if len(y_lake) > 1 else np.nan
+        )
+        results_df_row[f"{model_name}_rmse"] = root_mean_squared_error(
+            y_lake, predicted_lake
+        )
+        results_df_row[f"{model_name}_mae"] = mean_absolute_error(
+            y_lake, predicted_lake
+        )
+        results_df_row["number_truth_values"] = len(y_lake)
+        results_df_row["OBJECTID"] = float(lakeid)
+        results_df_row["NAME"] = (
+            lake_geometry.get_lake_name(lakeid)
+            if lake_geometry.has_local_lake(lakeid)
+            else None
+        )
+        list_of_results_df_rows.append(results_df_row)
+
+    return pd.DataFrame(list_of_results_df_rows)
+
+
+def train_and_evaluate(
+    alg_df,
+    alg,
+    hyperparameters,
+    n_splits=5,
+    workers=multiprocessing.cpu_count(),
+    cache_root="model_cache",
+    models_dir="models",
+):
+    X, y, groups = get_features_and_target(alg_df)
+    n_splits = min(n_splits, len(np.unique(groups)))
+    if n_splits < 2:
+        raise Exception(f"{alg} needs at least 2 lakes for grouped cross validation.")
+
+    cache_key = get_cache_key(X, y, groups, hyperparameters, n_splits)
+    cache_dir = os.path.join(cache_root, f"{alg}_{cache_key}")
+    results_path = os.path.join(cache_dir, "results.csv")
+    cached_final_model_path = os.path.join(cache_dir, "final_model.joblib")
+    final_model_path = os.path.join(models_dir, f"rf_{alg}.joblib")
+
+    if not os.path.exists(models_dir):
+        os.makedirs(models_dir)
+    if os.path.exists(results_path) and os.path.exists(cached_final_model_path):
+        print(f"{alg}: unchanged data and hyperparameters, using {cache_dir}")
+        shutil.copyfile(cached_final_model_path, final_model_path)
+        return pd.read_csv(results_path)
+
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    splits = get_fold_splits(X, y, groups, n_splits, cache_dir)
+
+    # folds run in parallel, cores left over go to each forest's trees
+    fold_workers = min(n_splits, workers)
+    model_n_jobs = max(1, workers // fold_workers)
+    fold_predictions = joblib.Parallel(n_jobs=fold_workers)(
+        joblib.delayed(fit_fold)(
+            X,
+            y,
+            train_index,
+            test_index,
+            hyperparameters,
+            model_n_jobs,
+            os.path.join(cache_dir, f"fold_{fold_index}.joblib"),
+        )
+        for fold_index, (train_index, test_index) in enumerate(splits)
+    )
+
+    predictions = np.full(len(y), np.nan)
+    for (train_index, test_index), fold_prediction in zip(splits, fold_predictions):
+        predictions[test_index] = fold_prediction  # out of fold, every row predicted once
+
+    print(
+        f"{alg}: grouped {n_splits}-fold r2 {r2_score(y, predictions):.3f}, rmse {root_mean_squared_error(y, predictions):.3f}, mae {mean_absolute_error(y, predictions):.3f} (ln doc)"
+    )
+
+    results_df = get_results_df(y, predictions, groups, "rf")
+
+    # final model on every lake, for predicting maps
+    final_model = RandomForestRegressor(n_jobs=workers, **hyperparameters)
+    final_model.fit(X, y)
+    final_model.n_jobs = 1  # don't carry this machine's core count into prediction workers
+    joblib.dump(
+        {
+            "model": final_model,
+            "band_names": band_names,
+            "target": "ln_doc",
+            "alg": alg,
+            "hyperparameters": hyperparameters,
+            "cache_key": cache_key,
+        },
+        cached_final_model_path,
+        compress=3,
+    )
+    shutil.copyfile(cached_final_model_path, final_model_path)
+    results_df.to_csv(results_path, index=False)  # written last, marks this cache entry complete
+
+    return results_df
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "training_data",
+        help="training_data.csv, or the parquet dataset dir from assemble_training_df.py --parquet",
+    )
+    parser.add_argument("--algs", nargs="+", default=None, help="e.g. MAIN L2 ACOLITE")
+    parser.add_argument("--n-splits", type=int, default=5)
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--cache-dir", default="model_cache")
+    parser.add_argument("--models-dir", default="models")
+    parser.add_argument(
+        "--n-estimators", type=int, default=default_hyperparameters["n_estimators"]
+    )
+    parser.add_argument(
+        "--max-depth", type=int, default=default_hyperparameters["max_depth"]
+    )
+    parser.add_argument(
+        "--min-samples-leaf",
+        type=int,
+        default=default_hyperparameters["min_samples_leaf"],
+    )
+    parser.add_argument(
+        "--max-features", type=float, default=default_hyperparameters["max_features"]
+    )
+    parser.add_argument(
+        "--random-state", type=int, default=default_hyperparameters["random_state"]
+    )
+    args = parser.parse_args()
+
+    hyperparameters = {
+        "n_estimators": args.n_estimators,
+        "max_depth": args.max_depth,
+        "min_samples_leaf": args.min_samples_leaf,
+        "max_features": args.max_features,
+        "random_state": args.random_state,
+    }
+
+    training_df = load_training_data(args.training_data, args.algs)
+    algs = args.algs if args.algs else sorted(training_df["alg"].unique())
+
+    for alg in algs:
+        results_df = train_and_evaluate(
+            training_df[training_df["alg"] == alg],
+            alg,
+            hyperparameters,
+            n_splits=args.n_splits,
+            workers=args.workers,
+            cache_root=args.cache_dir,
+            models_dir=args.models_dir,
+        )
+        results_df.to_csv(f"results_rf_{alg}.csv")
+        print(f"Results ({alg}): \n", results_df)